@@ -1,15 +1,21 @@
 from __future__ import unicode_literals
 
+from celery import current_app
+from celery.backends.base import DisabledBackend
+from celery.result import AsyncResult
 from raster.models import RasterLayer
 
 from django import forms
+from django.conf.urls import url
 from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
 from django.contrib.gis import admin
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils.http import urlencode
 
-from .models import AggregationArea, AggregationLayer, AggregationLayerGroup, ValueCountResult
-from .tasks import aggregation_layer_parser, compute_value_count_for_aggregation_layer
+from .models import AggregationArea, AggregationLayer, AggregationLayerGroup, AggregationLayerWarning, ValueCountResult
+from .tasks import aggregation_layer_parser, schedule_value_count_for_aggregation_layer, task_options
 
 
 class ValueCountResultAdmin(admin.ModelAdmin):
@@ -31,7 +37,7 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
 
     readonly_fields = ['modified']
 
-    actions = ['parse_shapefile_data', 'compute_value_count', ]
+    actions = ['parse_shapefile_data', 'parse_shapefile_data_incrementally', 'compute_value_count', ]
 
     search_fields = ('name', )
 
@@ -44,10 +50,59 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
                 "Parsing shapefile asynchronously, please check the collection parse log for status.",
             )
 
+    def parse_shapefile_data_incrementally(self, request, queryset):
+        for lyr in queryset.all():
+            lyr.log('Scheduled incremental shapefile parsing.', AggregationLayer.PENDING)
+            aggregation_layer_parser.delay(lyr.id, incremental=True)
+            self.message_user(
+                request,
+                "Parsing shapefile incrementally, please check the collection parse log for status.",
+            )
+
+    def get_urls(self):
+        urls = [
+            url(
+                r'^valuecount-progress/$',
+                self.admin_site.admin_view(self.value_count_progress),
+                name='raster_aggregation_aggregationlayer_valuecount_progress',
+            ),
+        ]
+        return urls + super(ComputeActivityAggregatesModelAdmin, self).get_urls()
+
+    def task_state(self, task_id):
+        """
+        Get the state of a scheduled value count task, or UNKNOWN if the state
+        can not be read because no result backend is configured.
+        """
+        if isinstance(current_app.backend, DisabledBackend):
+            return 'UNKNOWN'
+        try:
+            result = AsyncResult(task_id)
+            state = result.state
+            # Follow the task that completes the scheduled value counts.
+            if state == 'SUCCESS' and result.result:
+                state = AsyncResult(result.result).state
+        except:
+            return 'UNKNOWN'
+        return state
+
+    def value_count_progress(self, request):
+        """
+        Show the state of the value count tasks scheduled from the admin.
+        """
+        tasks = [(task_id, self.task_state(task_id)) for task_id in request.GET.getlist('task')]
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Value Count Progress',
+            tasks=tasks,
+            finished=all(state in ('SUCCESS', 'FAILURE', 'UNKNOWN') for task_id, state in tasks),
+        )
+        return render(request, 'raster_aggregation/valuecount_progress.html', context)
+
     def compute_value_count(self, request, queryset):
 
         form = None
-        layer = queryset[0]
 
         # After posting, set the new name to file field
         if 'apply' in request.POST:
@@ -56,19 +111,28 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
             if form.is_valid():
                 rasterlayers = form.cleaned_data['rasterlayers']
 
-                for rst in rasterlayers:
-                    compute_value_count_for_aggregation_layer(
-                        layer,
-                        rst.id,
-                        compute_area=True
-                    )
+                # Schedule one task per aggregation layer and raster.
+                task_ids = []
+                for layer in queryset:
+                    layer.log('Scheduled Value Count on {count} rasters.'.format(count=rasterlayers.count()))
+                    for rst in rasterlayers:
+                        task_ids.append(
+                            schedule_value_count_for_aggregation_layer.apply_async(
+                                (layer.id, rst.id), {'compute_area': True}, **task_options()
+                            ).id
+                        )
 
                 self.message_user(
                     request,
-                    "Started Value Count on \"{agg}\" with {count} rasters. "
-                    "Check parse log for results.".format(agg=layer, count=rasterlayers.count())
+                    "Started Value Count on {layers} aggregation layers with {count} rasters. "
+                    "Check parse log for results.".format(layers=queryset.count(), count=rasterlayers.count())
+                )
+                return HttpResponseRedirect(
+                    '{url}?{query}'.format(
+                        url=reverse('admin:raster_aggregation_aggregationlayer_valuecount_progress'),
+                        query=urlencode([('task', task_id) for task_id in task_ids]),
+                    )
                 )
-                return HttpResponseRedirect(request.get_full_path())
 
         # Before posting, prepare empty action form
         if not form:
@@ -98,6 +162,12 @@ class AggregationLayerGroupAdmin(admin.ModelAdmin):
     exclude = ['aggregationlayers']
 
 
+class AggregationLayerWarningAdmin(admin.ModelAdmin):
+    list_display = ('aggregationlayer', 'fid', 'message', 'created')
+    list_filter = ('aggregationlayer', )
+    readonly_fields = ('aggregationlayer', 'fid', 'message', 'created')
+
+
 class AggregationAreaAdmin(admin.OSMGeoAdmin):
     raw_id_fields = ('aggregationlayer', )
     search_fields = ('name', )
@@ -107,3 +177,4 @@ admin.site.register(AggregationArea, AggregationAreaAdmin)
 admin.site.register(ValueCountResult, ValueCountResultAdmin)
 admin.site.register(AggregationLayer, ComputeActivityAggregatesModelAdmin)
 admin.site.register(AggregationLayerGroup, AggregationLayerGroupAdmin)
+admin.site.register(AggregationLayerWarning, AggregationLayerWarningAdmin)
@@ -0,0 +1,229 @@
+from __future__ import unicode_literals
+
+import ctypes
+import threading
+from collections import OrderedDict
+
+import numpy
+from raster.algebra.parser import RasterAlgebraParser
+from raster.rasterize import rasterize
+from raster.tiles.lookup import get_raster_tile
+from raster.valuecount import Aggregator
+
+from django.conf import settings
+from django.contrib.gis.gdal.raster.const import GDAL_TO_CTYPES
+from django.db.models import F
+from raster_aggregation.const import TILE_CACHE_SIZE
+from raster_aggregation.masks import mask_cache
+
+
+def raster_size(rast):
+    """
+    Number of bytes of the pixel data of a raster.
+    """
+    size = 0
+    for band in rast.bands:
+        ctype = GDAL_TO_CTYPES[band.datatype()]
+        size += rast.width * rast.height * (ctypes.sizeof(ctype) if ctype else 8)
+    return size
+
+
+class TileCache(object):
+    """
+    Least recently used cache for raster tiles, shared by all aggregators in
+    a process and bounded by the number of bytes of the cached rasters.
+
+    Tiles are keyed by raster layer, layer version, zoom and tile indices. The
+    layer versions are stored in the database so that a change of a raster
+    layer in one process invalidates the tiles in all processes. Missing
+    tiles are not cached, they may be written by a parser that is running.
+    """
+
+    def __init__(self):
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return getattr(settings, 'RASTER_AGGREGATION_TILE_CACHE_SIZE', TILE_CACHE_SIZE)
+
+    def versions(self, layer_ids):
+        """
+        Get the current versions of a list of raster layers.
+        """
+        # Avoid a circular import, the models module depends on the cache.
+        from raster_aggregation.models import RasterLayerVersion
+
+        versions = {int(layer_id): 0 for layer_id in layer_ids}
+        versions.update(RasterLayerVersion.objects.filter(
+            rasterlayer_id__in=list(versions),
+        ).values_list('rasterlayer_id', 'version'))
+        return versions
+
+    def get(self, layer_id, zoom, tilex, tiley, version=0):
+        """
+        Get a raster tile from the cache, or from the database if it is not
+        cached yet.
+        """
+        key = (int(layer_id), version, zoom, tilex, tiley)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key][0]
+            self.misses += 1
+
+        tile = get_raster_tile(layer_id, zoom, tilex, tiley)
+        if tile is None:
+            return tile
+
+        size = raster_size(tile)
+        if size <= self.max_bytes:
+            with self._lock:
+                if key not in self._tiles:
+                    self._tiles[key] = (tile, size)
+                    self._bytes += size
+                # Evict least recently used tiles.
+                while self._bytes > self.max_bytes:
+                    self._bytes -= self._tiles.popitem(last=False)[1][1]
+
+        return tile
+
+    def invalidate(self, layer_id):
+        """
+        Drop the tiles of a raster layer from this cache and bump the layer
+        version to invalidate the tiles cached by other processes.
+        """
+        with self._lock:
+            for key in [key for key in self._tiles if key[0] == layer_id]:
+                self._bytes -= self._tiles.pop(key)[1]
+
+        # Avoid a circular import, the models module depends on the cache.
+        from raster_aggregation.models import RasterLayerVersion
+
+        if not RasterLayerVersion.objects.filter(rasterlayer_id=layer_id).update(version=F('version') + 1):
+            version, created = RasterLayerVersion.objects.get_or_create(rasterlayer_id=layer_id, defaults={'version': 1})
+            if not created:
+                RasterLayerVersion.objects.filter(rasterlayer_id=layer_id).update(version=F('version') + 1)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Return the hit and miss counters, the number of cached tiles and
+        their size in bytes.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'tiles': len(self._tiles),
+                'bytes': self._bytes,
+            }
+
+
+tile_cache = TileCache()
+
+
+class CachedAggregator(Aggregator):
+    """
+    Aggregator that reads raster tiles through the process wide tile cache.
+
+    If the tile coverage of the geometry is provided, only the covering tiles
+    are read and tiles in the interior of the geometry are not masked. With a
+    mask key of an area id and fingerprint, the masks of the boundary tiles
+    are read from the mask cache. The heartbeat function is called for every
+    tile that is read.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.coverage = kwargs.pop('coverage', None)
+        self.mask_key = kwargs.pop('mask_key', None)
+        self.heartbeat = kwargs.pop('heartbeat', None)
+        super(CachedAggregator, self).__init__(*args, **kwargs)
+        self.tile_versions = tile_cache.versions(self.layer_dict.values())
+
+    def get_raster_tile(self, layerid, zoom, tilex, tiley):
+        # Signal progress of long running aggregations.
+        if self.heartbeat:
+            self.heartbeat()
+        return tile_cache.get(layerid, zoom, tilex, tiley, self.tile_versions[int(layerid)])
+
+    def evaluate_tile(self, algebra_parser, tilex, tiley):
+        """
+        Evaluate the formula on a tile. Returns the result raster and its band
+        data as masked array, or None if the tile is missing in any of the
+        input layers.
+        """
+        # Prepare a data dictionary with named tiles for algebra evaluation
+        data = {}
+        for name, layerid in self.layer_dict.items():
+            tile = self.get_raster_tile(layerid, self.zoom, tilex, tiley)
+            if tile:
+                data[name] = tile
+            else:
+                return None
+
+        # Compute raster algebra
+        result = algebra_parser.evaluate_raster_algebra(data, self.formula)
+
+        # Convert band data to masked array
+        return result, numpy.ma.masked_values(
+            result.bands[0].data(),
+            result.bands[0].nodata_value,
+        )
+
+    def tiles(self):
+        if not self.tilerange:
+            return
+
+        # Only visit the covering tiles if the coverage is known.
+        if self.coverage is not None and self.geom:
+            indices = sorted(
+                (tilex, tiley) for tilex, tiley in self.coverage
+                if self.tilerange[0] <= tilex <= self.tilerange[2] and self.tilerange[1] <= tiley <= self.tilerange[3]
+            )
+        else:
+            indices = (
+                (tilex, tiley)
+                for tilex in range(self.tilerange[0], self.tilerange[2] + 1)
+                for tiley in range(self.tilerange[1], self.tilerange[3] + 1)
+            )
+
+        algebra_parser = RasterAlgebraParser()
+
+        for tilex, tiley in indices:
+            evaluated = self.evaluate_tile(algebra_parser, tilex, tiley)
+            if evaluated is None:
+                continue
+            result, result_data = evaluated
+
+            if self.geom and self.coverage is not None:
+                if not self.coverage[(tilex, tiley)]:
+                    result_data.mask = result_data.mask | ~self.geom_mask(result, tilex, tiley)
+                # The result raster has the same pixel scale as the rasterized
+                # geometry.
+                self.rastgeom = result
+            elif self.geom:
+                result_data = self.mask_by_geom(result, result_data)
+
+            yield result_data.compressed()
+
+    def geom_mask(self, tile, tilex, tiley):
+        """
+        Boolean array of the pixels of a tile that are inside the geometry.
+        """
+        def build():
+            return rasterize(self.geom, tile, all_touched=self.all_touched).bands[0].data() == 1
+
+        if self.mask_key is None:
+            return build()
+        return mask_cache.get(self.mask_key, self.zoom, tilex, tiley, self.all_touched, build)
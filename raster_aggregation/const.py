@@ -0,0 +1,94 @@
+"""
+Default values for the raster aggregation settings. Each value can be
+overridden through a django setting with the same name prefixed by
+RASTER_AGGREGATION_, for instance RASTER_AGGREGATION_PARSE_BATCH_SIZE.
+"""
+# Number of aggregation areas that are written to the database at once while
+# parsing a shapefile.
+PARSE_BATCH_SIZE = 500
+
+# Number of features per parser subtask. Layers with more features are split
+# into shards that are parsed in parallel. Sharding is disabled if None.
+PARSE_SHARD_SIZE = None
+
+# Number of buffered parse log messages and the time interval in seconds
+# after which the buffer is written to the database.
+PARSE_LOG_BUFFER_SIZE = 100
+PARSE_LOG_FLUSH_INTERVAL = 10
+
+# Maximum number of characters kept in the parse log, older messages are
+# dropped first. The log length is unbounded if None.
+PARSE_LOG_MAX_LENGTH = 1000000
+
+# Zoom levels for which simplified aggregation area geometries are
+# precomputed. The geometry of a level is used for all lower zoom levels, the
+# full resolution geometry is used beyond the highest level.
+PYRAMID_ZOOM_LEVELS = (0, 3, 6, 9)
+
+# Number of consecutive area ids that are simplified in one update statement.
+SIMPLIFICATION_CHUNK_SIZE = 5000
+
+# Defer the simplification of parsed areas to a single database update after
+# all features were parsed.
+DEFER_SIMPLIFICATION = False
+
+# Maximum number of bytes of raster tiles that are kept in the tile cache of
+# each process. Set to zero to disable the tile cache.
+TILE_CACHE_SIZE = 100 * 1024 * 1024
+
+# Number of value count results that are computed by one subtask.
+VALUE_COUNT_CHUNK_SIZE = 50
+
+# Compute the value counts of a chunk together in a single pass over the
+# raster tiles. Tiles shared by several areas are only read once per chunk.
+ZONAL = False
+
+# Compute value count results again when they are outdated by a change of
+# a raster layer.
+REQUEUE_OUTDATED = False
+
+# Budgets for a run of the sweeper that computes outdated and failed value
+# count results again: the maximum number of results, the estimated number
+# of pixels and the number of seconds. A budget of None is unlimited, with
+# a time budget the results are computed by the sweeper task itself.
+SWEEP_MAX_ROWS = 1000
+SWEEP_MAX_PIXELS = None
+SWEEP_MAX_SECONDS = None
+
+# Number of seconds after which failed results are computed again.
+SWEEP_RETRY_DELAY = 3600
+
+# Number of seconds a worker may compute a value count result before the
+# result can be claimed by another worker.
+VALUE_COUNT_LEASE = 3600
+
+# Celery queues and task priorities for value counts requested through the
+# api and for bulk computations on entire layers. The default queue and
+# priority are used if None.
+INTERACTIVE_QUEUE = None
+INTERACTIVE_PRIORITY = None
+BULK_QUEUE = None
+BULK_PRIORITY = None
+
+# Maximum number of bulk value count tasks that compute at the same time, to
+# keep workers available for interactive work. Unlimited if None. Bulk tasks
+# that do not get a slot are retried after a delay in seconds.
+BULK_CONCURRENCY = None
+BULK_RETRY_DELAY = 30
+
+# Estimated number of pixels above which the area of a value count result is
+# split into blocks of the tile grid that are computed in parallel. Areas
+# are never split if None.
+SUBDIVIDE_PIXELS = 50000000
+
+# Maximum estimated number of pixels of the value count results that are
+# computed at the same time across all workers. Tasks that exceed the budget
+# are retried after a delay in seconds. The budget is unlimited if None.
+MAX_RUNNING_PIXELS = None
+ADMISSION_RETRY_DELAY = 30
+
+# Directory of the disk cache for rasterized area masks, which is shared by
+# all worker processes on a node, and its maximum size in bytes. The mask
+# cache is disabled if the directory is None.
+MASK_CACHE_DIR = None
+MASK_CACHE_SIZE = 1024 * 1024 * 1024
@@ -0,0 +1,109 @@
+from __future__ import unicode_literals
+
+from raster.models import RasterLayer, RasterTile
+from raster.tiles.const import WEB_MERCATOR_TILESIZE
+from raster.tiles.utils import tile_index_range
+
+from django.conf import settings
+from django.db.models import BigIntegerField, Case, Count, F, Func, IntegerField, Q, Sum, Value, When
+from raster_aggregation.utils import WEB_MERCATOR_SRID
+
+
+def estimate_value_count(geom, layer_ids, zoom):
+    """
+    Estimate the cost of a value count for an area from the raster tile index,
+    without reading any pixels. Returns the number of tiles that are read for
+    all layers, the number of pixels that are evaluated and the number of
+    bytes of the stored tiles.
+
+    Layers are read at the zoom level or at their maximum zoom level if it is
+    lower, in which case their tiles are warped from parent tiles. The tiles
+    are counted where all layers have data at the lowest of these levels and
+    scaled to the zoom level.
+    """
+    layer_ids = set(int(layer_id) for layer_id in layer_ids)
+    zooms = {
+        layer_id: zoom if max_zoom is None else min(zoom, max_zoom)
+        for layer_id, max_zoom in RasterLayer.objects.filter(
+            id__in=layer_ids,
+        ).values_list('id', 'metadata__max_zoom')
+    }
+    if not zooms:
+        return {'zoom': zoom, 'tiles': 0, 'pixels': 0, 'bytes': 0}
+    base = min(zooms.values())
+
+    if geom.srid != WEB_MERCATOR_SRID:
+        geom = geom.transform(WEB_MERCATOR_SRID, clone=True)
+
+    selection = Q()
+    for layer_id, layer_zoom in zooms.items():
+        xmin, ymin, xmax, ymax = tile_index_range(geom.extent, layer_zoom)
+        selection |= Q(
+            rasterlayer_id=layer_id,
+            tilez=layer_zoom,
+            tilex__gte=xmin,
+            tilex__lte=xmax,
+            tiley__gte=ymin,
+            tiley__lte=ymax,
+        )
+    tiles = RasterTile.objects.filter(selection)
+
+    # Tiles are only evaluated where all layers have data, which is counted
+    # on the parent tiles at the lowest zoom level of the layers.
+    def parent(field):
+        return Case(*[
+            When(rasterlayer_id=layer_id, then=F(field) / Value(2 ** (layer_zoom - base)))
+            for layer_id, layer_zoom in zooms.items()
+        ], output_field=IntegerField())
+
+    parents = tiles.annotate(
+        parentx=parent('tilex'),
+        parenty=parent('tiley'),
+    ).values('parentx', 'parenty').annotate(
+        layers=Count('rasterlayer_id', distinct=True),
+    ).filter(layers=len(layer_ids)).count()
+
+    # Each parent tile holds a block of tiles at the zoom level, but no more
+    # tiles are read than the area touches.
+    xmin, ymin, xmax, ymax = tile_index_range(geom.extent, zoom)
+    nr_of_tiles = min(parents * 4 ** (zoom - base), (xmax - xmin + 1) * (ymax - ymin + 1))
+
+    # The stored size of the tiles is read from the column headers.
+    size = tiles.aggregate(
+        size=Sum(Func(F('rast'), function='pg_column_size', output_field=BigIntegerField())),
+    )['size']
+
+    tilesize = int(getattr(settings, 'RASTER_TILESIZE', WEB_MERCATOR_TILESIZE))
+
+    return {
+        'zoom': zoom,
+        'tiles': nr_of_tiles,
+        'pixels': nr_of_tiles * tilesize ** 2,
+        'bytes': size or 0,
+    }
+
+
+def select_zoom(rasterlayers, minmaxzoom=False, maxzoom=None, geom=None, max_pixels=None):
+    """
+    Select the zoom level for a value count. Work at the resolution of the
+    input layer with the highest zoom level by default, or the lowest one if
+    requested. With an area and a pixel budget, the zoom level is reduced
+    until the estimated number of pixels fits into the budget.
+    """
+    zlevels = [rst.metadata.max_zoom for rst in rasterlayers]
+    if minmaxzoom:
+        # Get the minimum of maxzoom levels
+        zoom = min(zlevels)
+    elif maxzoom is not None:
+        # Limit maximum zoom level
+        zoom = min(max(zlevels), maxzoom)
+    else:
+        # Compute at the maximum maxzoom (resolution of highest definition layer)
+        zoom = max(zlevels)
+
+    if geom is not None and max_pixels:
+        layer_ids = [rst.id for rst in rasterlayers]
+        while zoom > 0 and estimate_value_count(geom, layer_ids, zoom)['pixels'] > max_pixels:
+            zoom -= 1
+
+    return zoom
@@ -11,3 +11,19 @@ class MissingQueryParameter(APIException):
 class DuplicateError(APIException):
     status_code = 400
     default_detail = 'A value count object with this properties already exists.'
+
+
+class MixedResultsError(APIException):
+    status_code = 400
+    default_detail = (
+        'The results were computed with different parameters, filter them by '
+        'formula, layer names, zoom, units and grouping.'
+    )
+
+
+class UnmergeableResultsError(APIException):
+    status_code = 400
+    default_detail = (
+        'The histogram bins of the results depend on their data, compute them '
+        'with a range to merge them.'
+    )
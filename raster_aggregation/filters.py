@@ -10,8 +10,15 @@ class HStoreFieldFilter(django_filters.filters.Filter):
     field_class = HStoreFormField
 
 
+class NumberInFilter(django_filters.filters.BaseInFilter, django_filters.filters.NumberFilter):
+    pass
+
+
 class ValueCountResultFilter(django_filters.FilterSet):
 
+    aggregationareas = NumberInFilter(field_name='aggregationarea', lookup_expr='in')
+    attributes = HStoreFieldFilter(field_name='aggregationarea__attributes', lookup_expr='contains')
+
     class Meta:
         model = ValueCountResult
         fields = (
@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from raster_aggregation.models import AggregationArea
+
+
+class Command(BaseCommand):
+    help = 'Create expression indexes on aggregation area attribute keys used for grouping value count results.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('keys', nargs='+', help='Attribute keys to index.')
+        parser.add_argument('--drop', action='store_true', help='Drop the indexes instead of creating them.')
+
+    def handle(self, *args, **options):
+        for key in options['keys']:
+            # The key is part of the index expression and name.
+            if not re.match(r'^\w{1,32}$', key):
+                raise CommandError('Invalid attribute key "{0}".'.format(key))
+
+            name = connection.ops.quote_name('raster_aggregation_attributes_{0}'.format(key))
+            if options['drop']:
+                sql = 'DROP INDEX CONCURRENTLY IF EXISTS {name}'.format(name=name)
+            else:
+                sql = "CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ((attributes -> '{key}'))".format(
+                    name=name,
+                    table=AggregationArea._meta.db_table,
+                    key=key,
+                )
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+
+            self.stdout.write('{0} index {1}.'.format('Dropped' if options['drop'] else 'Created', name))
@@ -0,0 +1,23 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from raster_aggregation.models import AggregationLayer
+
+
+class Command(BaseCommand):
+    help = 'Recompute the simplified geometries of aggregation areas in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'agglayer_ids', nargs='*', type=int,
+            help='Ids of the aggregation layers to simplify, all layers if omitted.',
+        )
+
+    def handle(self, *args, **options):
+        agglayers = AggregationLayer.objects.all()
+        if options['agglayer_ids']:
+            agglayers = agglayers.filter(id__in=options['agglayer_ids'])
+
+        for agglayer in agglayers:
+            self.stdout.write('Simplifying aggregation layer {0}.'.format(agglayer.id))
+            agglayer.simplify_areas()
@@ -0,0 +1,21 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from raster_aggregation.tasks import sweep_value_count_results
+
+
+class Command(BaseCommand):
+    help = 'Compute outdated and failed value count results again within a budget.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, help='Maximum number of results.')
+        parser.add_argument('--pixels', type=int, help='Maximum estimated number of pixels.')
+        parser.add_argument('--seconds', type=int, help='Compute the results in this process for at most this time.')
+
+    def handle(self, *args, **options):
+        count = sweep_value_count_results(
+            max_rows=options['rows'],
+            max_pixels=options['pixels'],
+            max_seconds=options['seconds'],
+        )
+        self.stdout.write('Swept {0} value count results.'.format(count))
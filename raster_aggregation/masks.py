@@ -0,0 +1,187 @@
+from __future__ import unicode_literals
+
+import fcntl
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy
+
+from django.conf import settings
+from raster_aggregation.const import MASK_CACHE_DIR, MASK_CACHE_SIZE
+
+# Name of the file in the cache directory that tracks the size of the cache.
+SIZE_FILE = '.size'
+
+# Fraction of the maximum size that the cache is reduced to by an eviction.
+EVICTION_TARGET = 0.9
+
+
+class MaskCache(object):
+    """
+    Disk cache for the rasterized masks of aggregation areas on raster tiles,
+    shared by all processes on a node through memory mapped files.
+
+    Masks are stored in one directory per area and keyed by the fingerprint
+    of the area, so that masks of changed geometries are not used again. The
+    size of the cache is bounded, the least recently used masks are removed
+    first. The size is tracked in a counter file that is shared by all
+    processes, so that the cache is only scanned when it is full.
+    """
+
+    @property
+    def directory(self):
+        return getattr(settings, 'RASTER_AGGREGATION_MASK_CACHE_DIR', MASK_CACHE_DIR)
+
+    @property
+    def max_bytes(self):
+        return getattr(settings, 'RASTER_AGGREGATION_MASK_CACHE_SIZE', MASK_CACHE_SIZE)
+
+    def path(self, area_id, fingerprint, zoom, tilex, tiley, all_touched):
+        return os.path.join(
+            self.directory,
+            str(area_id),
+            '{0}-{1}-{2}-{3}-{4}.npy'.format(fingerprint, zoom, tilex, tiley, int(all_touched)),
+        )
+
+    def get(self, key, zoom, tilex, tiley, all_touched, build):
+        """
+        Get the mask of an area on a tile, where key is a tuple of the area id
+        and fingerprint. Masks that are not cached are computed with build and
+        stored. Returns a boolean array, memory mapped if it was cached.
+        """
+        if not self.directory:
+            return build()
+
+        path = self.path(key[0], key[1], zoom, tilex, tiley, all_touched)
+        try:
+            mask = numpy.load(path, mmap_mode='r')
+            # Track the last use for the eviction.
+            os.utime(path, None)
+            return mask
+        except (IOError, OSError, ValueError):
+            pass
+
+        mask = build()
+        self.store(path, mask)
+        return mask
+
+    @contextmanager
+    def size_counter(self):
+        """
+        Lock the size counter of the cache for this process. Yields a function
+        that adds a number of bytes to the counter and returns the new size.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, SIZE_FILE), 'a+') as counter:
+            fcntl.flock(counter, fcntl.LOCK_EX)
+            try:
+                def add(nr_of_bytes):
+                    counter.seek(0)
+                    try:
+                        size = int(counter.read() or 0)
+                    except ValueError:
+                        size = 0
+                    size = max(0, size + nr_of_bytes)
+                    counter.seek(0)
+                    counter.truncate()
+                    counter.write(str(size))
+                    counter.flush()
+                    return size
+                yield add
+            finally:
+                fcntl.flock(counter, fcntl.LOCK_UN)
+
+    def store(self, path, mask):
+        """
+        Write a mask to a temporary file that is moved into place, so that other
+        processes never read partially written masks. Masks are evicted if the
+        cache exceeds its maximum size.
+        """
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(handle, 'wb') as tmpfile:
+                numpy.save(tmpfile, mask)
+            os.replace(tmp, path)
+            with self.size_counter() as add:
+                size = add(os.path.getsize(path))
+        except (IOError, OSError):
+            return
+
+        if size > self.max_bytes:
+            self.evict(int(self.max_bytes * EVICTION_TARGET))
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used masks until the cache fits into its
+        maximum size, or into the given number of bytes. Area directories
+        that are emptied are removed as well.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        with self.size_counter() as add:
+            files = []
+            for root, dirs, names in os.walk(self.directory):
+                for name in names:
+                    if not name.endswith('.npy'):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+            size = sum(file_size for mtime, file_size, path in files)
+            emptied = set()
+            for mtime, file_size, path in sorted(files):
+                if size <= max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= file_size
+                emptied.add(os.path.dirname(path))
+
+            for directory in emptied:
+                try:
+                    # Only succeeds if no masks are left in the directory.
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+            # Reset the counter to the size that was found.
+            add(size - add(0))
+
+    def invalidate(self, area_ids):
+        """
+        Remove the masks of a list of areas.
+        """
+        if not self.directory:
+            return
+        for area_id in area_ids:
+            directory = os.path.join(self.directory, str(area_id))
+            if not os.path.isdir(directory):
+                continue
+            size = 0
+            for name in os.listdir(directory):
+                if not name.endswith('.npy'):
+                    continue
+                try:
+                    size += os.path.getsize(os.path.join(directory, name))
+                except OSError:
+                    pass
+            shutil.rmtree(directory, ignore_errors=True)
+            try:
+                with self.size_counter() as add:
+                    add(-size)
+            except (IOError, OSError):
+                pass
+
+
+mask_cache = MaskCache()
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.10 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0025_auto_20200417_0337'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregationLayerWarning',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fid', models.IntegerField(blank=True, null=True)),
+                ('message', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('aggregationlayer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='raster_aggregation.AggregationLayer')),
+            ],
+        ),
+    ]
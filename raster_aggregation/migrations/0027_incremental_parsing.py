@@ -0,0 +1,41 @@
+# Generated by Django 2.2.10 on 2026-10-18 10:41
+
+from django.db import migrations, models
+from raster_aggregation.utils import area_fingerprint
+
+
+def backfill_fingerprints(apps, schema_editor):
+    """
+    Compute the fingerprints of existing areas, so that the first incremental
+    parse matches them.
+    """
+    AggregationArea = apps.get_model('raster_aggregation', 'AggregationArea')
+    areas = []
+    for area in AggregationArea.objects.filter(fingerprint='').only('id', 'name', 'attributes', 'geom').iterator():
+        area.fingerprint = area_fingerprint(area.geom, area.name, area.attributes)
+        areas.append(area)
+        if len(areas) >= 500:
+            AggregationArea.objects.bulk_update(areas, ['fingerprint'])
+            areas = []
+    AggregationArea.objects.bulk_update(areas, ['fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0026_aggregationlayerwarning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aggregationarea',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='aggregationlayer',
+            name='id_column',
+            field=models.CharField(blank=True, default='', help_text='Column with stable feature IDs, used to match areas when reparsing incrementally.', max_length=10),
+        ),
+        migrations.RunPython(backfill_fingerprints, migrations.RunPython.noop),
+    ]
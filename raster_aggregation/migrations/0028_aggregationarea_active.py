@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0027_incremental_parsing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aggregationarea',
+            name='active',
+            field=models.BooleanField(db_index=True, default=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.10 on 2026-10-18 13:27
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0028_aggregationarea_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregationAreaGeometry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.PositiveSmallIntegerField()),
+                ('geom', django.contrib.gis.db.models.fields.MultiPolygonField(srid=3857)),
+                ('aggregationarea', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='raster_aggregation.AggregationArea')),
+            ],
+            options={
+                'unique_together': {('aggregationarea', 'zoom')},
+            },
+        ),
+    ]
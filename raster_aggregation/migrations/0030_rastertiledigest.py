@@ -0,0 +1,29 @@
+# Generated by Django 2.2.10 on 2026-10-18 14:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0039_auto_20190313_0728'),
+        ('raster_aggregation', '0029_aggregationareageometry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RasterTileDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tilez', models.PositiveSmallIntegerField()),
+                ('tilex', models.IntegerField()),
+                ('tiley', models.IntegerField()),
+                ('digest', models.CharField(max_length=32)),
+                ('rasterlayer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='raster.RasterLayer')),
+            ],
+            options={
+                'unique_together': {('rasterlayer', 'tilez', 'tilex', 'tiley')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 14:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0030_rastertiledigest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuecountresult',
+            name='accessed',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text='Last time the result was read.', null=True),
+        ),
+    ]
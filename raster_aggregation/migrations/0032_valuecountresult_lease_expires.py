@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 14:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0031_valuecountresult_accessed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuecountresult',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Time until which the computation of the result is claimed.', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 16:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0032_valuecountresult_lease_expires'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuecountresult',
+            name='cost',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='Estimated number of pixels to compute.', null=True),
+        ),
+    ]
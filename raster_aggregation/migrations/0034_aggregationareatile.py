@@ -0,0 +1,44 @@
+# Generated by Django 2.2.10 on 2026-10-18 17:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0033_valuecountresult_cost'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregationAreaTile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.PositiveSmallIntegerField()),
+                ('tilez', models.PositiveSmallIntegerField()),
+                ('tilex', models.IntegerField()),
+                ('tiley', models.IntegerField()),
+                ('interior', models.BooleanField(default=False)),
+                ('aggregationarea', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='raster_aggregation.AggregationArea')),
+            ],
+            options={
+                'unique_together': {('aggregationarea', 'zoom', 'tilez', 'tilex', 'tiley')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AggregationAreaCoverage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.PositiveSmallIntegerField()),
+                ('xmin', models.IntegerField()),
+                ('ymin', models.IntegerField()),
+                ('xmax', models.IntegerField()),
+                ('ymax', models.IntegerField()),
+                ('aggregationarea', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='raster_aggregation.AggregationArea')),
+            ],
+            options={
+                'unique_together': {('aggregationarea', 'zoom')},
+            },
+        ),
+    ]
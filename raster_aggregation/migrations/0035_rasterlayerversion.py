@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-18 19:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0039_auto_20190313_0728'),
+        ('raster_aggregation', '0034_aggregationareatile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RasterLayerVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('rasterlayer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='raster.RasterLayer')),
+            ],
+        ),
+    ]
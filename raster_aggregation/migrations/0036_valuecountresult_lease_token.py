@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0035_rasterlayerversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='valuecountresult',
+            name='lease_token',
+            field=models.UUIDField(blank=True, editable=False, help_text='Identifies the claim of the worker that computes the result.', null=True),
+        ),
+    ]
@@ -1,16 +1,35 @@
 from __future__ import unicode_literals
 
 import datetime
+import math
+import time
+import uuid
 
-from raster.models import Legend, RasterLayer
+from raster.models import Legend, RasterLayer, RasterTile
+from raster.tiles.const import WEB_MERCATOR_TILESIZE
 from raster.tiles.parser import rasterlayers_parser_ended
-from raster.valuecount import Aggregator
+from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
 
+from django.conf import settings
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import MultiPolygon, Polygon
 from django.contrib.postgres.fields import HStoreField
+from django.contrib.postgres.fields.hstore import KeyTransform
+from django.core.exceptions import EmptyResultSet
+from django.db import connection, transaction
+from django.db.models import Case, F, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Concat, Right
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygon
+from django.utils import timezone
+from raster_aggregation.cache import CachedAggregator, tile_cache
+from raster_aggregation.const import (
+    PARSE_BATCH_SIZE, PARSE_LOG_BUFFER_SIZE, PARSE_LOG_FLUSH_INTERVAL, PARSE_LOG_MAX_LENGTH, PYRAMID_ZOOM_LEVELS,
+    REQUEUE_OUTDATED, SIMPLIFICATION_CHUNK_SIZE, SUBDIVIDE_PIXELS, VALUE_COUNT_LEASE
+)
+from raster_aggregation.estimate import estimate_value_count
+from raster_aggregation.masks import mask_cache
+from raster_aggregation.utils import SIMPLIFY_SQL, WEB_MERCATOR_SRID, area_fingerprint, convert_to_multipolygon
 
 
 class AggregationLayer(models.Model):
@@ -33,6 +52,7 @@ class AggregationLayer(models.Model):
     description = models.TextField(blank=True, null=True)
     shapefile = models.FileField(upload_to='shapefiles/aggregationlayers', blank=True, null=True)
     name_column = models.CharField(max_length=10, default='', blank=True)
+    id_column = models.CharField(max_length=10, default='', blank=True, help_text='Column with stable feature IDs, used to match areas when reparsing incrementally.')
     fields = HStoreField(blank=True, default=dict)
     min_zoom_level = models.IntegerField(default=0)
     max_zoom_level = models.IntegerField(default=18)
@@ -50,21 +70,158 @@ class AggregationLayer(models.Model):
             status=self.status,
         )
 
-    def log(self, msg, status=None):
+    # Buffers for log messages, warnings and status updates.
+    _log_messages = None
+    _log_warnings = None
+    _log_status = None
+    _log_flushed = None
+
+    def log(self, msg, status=None, buffered=False):
         """
         Write a message to the parse log of the aggregationlayer instance.
+
+        Buffered messages are kept in memory until the buffer is full, the
+        flush interval has passed, the status changes or an unbuffered
+        message is written. Only the parse log, status and modified columns
+        are written, other fields have to be saved by the caller.
         """
         # Prepare datetime stamp for log
         now = '[{0}] '.format(datetime.datetime.now().strftime('%Y-%m-%d %T'))
+        # Add message to buffer.
+        if self._log_messages is None:
+            self._log_messages = []
+            self._log_flushed = datetime.datetime.now()
+        self._log_messages.append('\n' + now + msg)
         # Update status if requested.
         if status:
             self.status = status
-        # Ensure log is not null.
-        if not self.parse_log:
-            self.parse_log = ''
-        # Write log message.
-        self.parse_log += '\n' + now + msg
-        self.save()
+            self._log_status = status
+            buffered = False
+        # Keep buffering until the buffer is full or the interval has passed.
+        if buffered:
+            size = getattr(settings, 'RASTER_AGGREGATION_PARSE_LOG_BUFFER_SIZE', PARSE_LOG_BUFFER_SIZE)
+            interval = getattr(settings, 'RASTER_AGGREGATION_PARSE_LOG_FLUSH_INTERVAL', PARSE_LOG_FLUSH_INTERVAL)
+            age = (datetime.datetime.now() - self._log_flushed).total_seconds()
+            buffered = len(self._log_messages) < size and age < interval
+        # Write log.
+        if not buffered:
+            self.flush_log()
+
+    def log_warning(self, msg, fid=None):
+        """
+        Write a buffered warning to the parse log and store it as a separate
+        warning entry.
+        """
+        if self._log_warnings is None:
+            self._log_warnings = []
+        self._log_warnings.append(AggregationLayerWarning(aggregationlayer=self, fid=fid, message=msg.strip()))
+        self.log(msg, buffered=True)
+
+    def flush_log(self):
+        """
+        Write buffered log messages and warnings to the database. Only the
+        parse log, status and modified columns are updated, the log is
+        appended in the database and trimmed to the maximum log length.
+        """
+        if self._log_messages:
+            text = ''.join(self._log_messages)
+            max_length = getattr(settings, 'RASTER_AGGREGATION_PARSE_LOG_MAX_LENGTH', PARSE_LOG_MAX_LENGTH)
+
+            # Append messages to the log in the database.
+            parse_log = Concat(Coalesce('parse_log', Value('')), Value(text), output_field=models.TextField())
+            if max_length:
+                parse_log = Right(parse_log, max_length)
+            update = {'parse_log': parse_log, 'modified': timezone.now()}
+            if self._log_status:
+                update['status'] = self._log_status
+            AggregationLayer.objects.filter(id=self.id).update(**update)
+
+            # Keep the log of this instance in sync.
+            self.parse_log = (self.parse_log or '') + text
+            if max_length:
+                self.parse_log = self.parse_log[-max_length:]
+
+        if self._log_warnings:
+            AggregationLayerWarning.objects.bulk_create(self._log_warnings)
+
+        self._log_messages = []
+        self._log_warnings = []
+        self._log_status = None
+        self._log_flushed = datetime.datetime.now()
+
+    def pyramid_zoom_levels(self):
+        """
+        Zoom levels for which simplified area geometries are stored.
+        """
+        levels = getattr(settings, 'RASTER_AGGREGATION_PYRAMID_ZOOM_LEVELS', PYRAMID_ZOOM_LEVELS)
+        return sorted(zoom for zoom in levels if self.min_zoom_level <= zoom <= self.max_zoom_level)
+
+    def build_geometry_pyramid(self, area_id=None):
+        """
+        Store simplified geometries of the areas of this layer for the pyramid
+        zoom levels, using the pixel size at each level as tolerance. Only
+        levels that do not exist yet are created.
+        """
+        sql = """
+            INSERT INTO {pyramid} (aggregationarea_id, zoom, geom)
+            SELECT area.id, %s, {simplified}
+            FROM {area} AS area
+            WHERE area.aggregationlayer_id = %s
+            AND NOT EXISTS (
+                SELECT 1 FROM {pyramid} AS level
+                WHERE level.aggregationarea_id = area.id AND level.zoom = %s
+            )
+        """.format(
+            pyramid=AggregationAreaGeometry._meta.db_table,
+            area=AggregationArea._meta.db_table,
+            simplified=SIMPLIFY_SQL.format(geom='area.geom'),
+        )
+        if area_id:
+            sql += ' AND area.id = %s'
+
+        with connection.cursor() as cursor:
+            for zoom in self.pyramid_zoom_levels():
+                params = [zoom, tile_scale(zoom), self.id, zoom]
+                if area_id:
+                    params.append(area_id)
+                cursor.execute(sql, params)
+
+    def simplify_areas(self, missing_only=False):
+        """
+        Recompute the simplified geometries of the areas of this layer in the
+        database, updating chunks of consecutive area ids at once.
+        """
+        sql = """
+            UPDATE {area} SET geom_simplified = {simplified}
+            WHERE aggregationlayer_id = %s AND id >= %s AND id < %s
+        """.format(
+            area=AggregationArea._meta.db_table,
+            simplified=SIMPLIFY_SQL.format(geom='geom'),
+        )
+        if missing_only:
+            sql += ' AND geom_simplified IS NULL'
+
+        ids = AggregationArea.all_objects.filter(aggregationlayer=self).aggregate(Min('id'), Max('id'))
+        if ids['id__min'] is None:
+            return
+
+        chunk_size = getattr(settings, 'RASTER_AGGREGATION_SIMPLIFICATION_CHUNK_SIZE', SIMPLIFICATION_CHUNK_SIZE)
+        with connection.cursor() as cursor:
+            for start in range(ids['id__min'], ids['id__max'] + 1, chunk_size):
+                cursor.execute(sql, [self.simplification_tolerance, self.id, start, start + chunk_size])
+
+
+class AggregationLayerWarning(models.Model):
+    """
+    Warnings issued while parsing an aggregation layer.
+    """
+    aggregationlayer = models.ForeignKey(AggregationLayer, on_delete=models.CASCADE)
+    fid = models.IntegerField(blank=True, null=True)
+    message = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{lyr} - fid {fid}: {msg}'.format(lyr=self.aggregationlayer.name, fid=self.fid, msg=self.message)
 
 
 class AggregationLayerGroup(models.Model):
@@ -98,6 +255,40 @@ class AggregationLayerZoomRange(models.Model):
         )
 
 
+class AggregationAreaQuerySet(models.QuerySet):
+
+    def annotate_zoom_geom(self, zoom, fallback='geom'):
+        """
+        Annotate the areas with the pyramid geometry that is appropriate for
+        the given zoom level as geom_zoom. Beyond the highest pyramid level,
+        the fallback geometry field is used.
+        """
+        levels = getattr(settings, 'RASTER_AGGREGATION_PYRAMID_ZOOM_LEVELS', PYRAMID_ZOOM_LEVELS)
+        if not any(level >= zoom for level in levels):
+            return self.annotate(geom_zoom=F(fallback))
+
+        level = AggregationAreaGeometry.objects.filter(
+            aggregationarea=OuterRef('pk'),
+            zoom__gte=zoom,
+        ).order_by('zoom').values('geom')[:1]
+
+        return self.annotate(geom_zoom=Coalesce(
+            Subquery(level),
+            fallback,
+            output_field=models.MultiPolygonField(srid=WEB_MERCATOR_SRID),
+        ))
+
+
+class AggregationAreaManager(models.Manager.from_queryset(AggregationAreaQuerySet)):
+    """
+    Only returns active aggregation areas, areas that are staged while
+    parsing a layer are hidden until they replace the current areas.
+    """
+
+    def get_queryset(self):
+        return super(AggregationAreaManager, self).get_queryset().filter(active=True)
+
+
 class AggregationArea(models.Model):
     """
     Aggregation area polygons.
@@ -107,6 +298,11 @@ class AggregationArea(models.Model):
     attributes = HStoreField(default=dict, blank=True)
     geom = models.MultiPolygonField(srid=WEB_MERCATOR_SRID)
     geom_simplified = models.MultiPolygonField(srid=WEB_MERCATOR_SRID, blank=True, null=True)
+    fingerprint = models.CharField(max_length=40, default='', blank=True, editable=False, db_index=True)
+    active = models.BooleanField(default=True, editable=False, db_index=True)
+
+    objects = AggregationAreaManager()
+    all_objects = models.Manager()
 
     def __str__(self):
         return "{lyr} - {name}".format(lyr=self.aggregationlayer.name, name=self.name)
@@ -115,13 +311,504 @@ class AggregationArea(models.Model):
         """
         Reduce the geometries to simplified version.
         """
+        self.simplify()
+        self.update_fingerprint()
+        super(AggregationArea, self).save(*args, **kwargs)
+
+        # Rebuild the geometry pyramid of this area.
+        self.aggregationareageometry_set.all().delete()
+        self.aggregationlayer.build_geometry_pyramid(area_id=self.id)
+
+        # The tile coverage and masks are rebuilt when they are used next.
+        self.aggregationareacoverage_set.all().delete()
+        self.aggregationareatile_set.all().delete()
+        mask_cache.invalidate([self.id])
+
+    def update_fingerprint(self):
+        """
+        Compute a hash of the geometry, name and attributes of this area.
+        Attribute values are hashed as strings, as they are stored in hstore.
+        """
+        self.fingerprint = area_fingerprint(self.geom, self.name, self.attributes)
+
+    def simplify(self):
+        """
+        Compute the simplified geometry based on the tolerance of the
+        aggregation layer.
+        """
         geom = self.geom.simplify(
             tolerance=self.aggregationlayer.simplification_tolerance,
             preserve_topology=True
         )
         geom = convert_to_multipolygon(geom)
         self.geom_simplified = geom
-        super(AggregationArea, self).save(*args, **kwargs)
+
+    def tile_coverage(self, zoom, tilerange):
+        """
+        Get the tiles that cover this area at a zoom level within a range of
+        tiles, see tile_coverages.
+        """
+        return tile_coverages([self], zoom, [tilerange])[0]
+
+    def build_tile_coverage(self, zoom, tilerange):
+        """
+        Compute the tiles that intersect this area at a zoom level within a
+        range of tiles. Yields unsaved AggregationAreaTile objects.
+
+        The tile pyramid is descended from zoom level zero. Tiles that are
+        entirely inside of the area are stored at the level where they were
+        found and are not descended further.
+        """
+        prepared = self.geom.prepared
+        tiles = [(0, 0, 0)]
+        while tiles:
+            tilex, tiley, tilez = tiles.pop()
+
+            # Skip tiles that are outside of the range at the target level.
+            shift = zoom - tilez
+            if not tilerange[0] >> shift <= tilex <= tilerange[2] >> shift:
+                continue
+            if not tilerange[1] >> shift <= tiley <= tilerange[3] >> shift:
+                continue
+
+            bbox = Polygon.from_bbox(tile_bounds(tilex, tiley, tilez))
+            bbox.srid = self.geom.srid
+            if not prepared.intersects(bbox):
+                continue
+            interior = prepared.contains(bbox)
+            if interior or tilez == zoom:
+                yield AggregationAreaTile(
+                    aggregationarea_id=self.id, zoom=zoom, tilez=tilez, tilex=tilex, tiley=tiley, interior=interior,
+                )
+            else:
+                for x in (2 * tilex, 2 * tilex + 1):
+                    for y in (2 * tiley, 2 * tiley + 1):
+                        tiles.append((x, y, tilez + 1))
+
+
+class AggregationAreaGeometry(models.Model):
+    """
+    Simplified geometries of aggregation areas for a set of zoom levels. The
+    geometry for a zoom level is valid for display at that level and below.
+    """
+    aggregationarea = models.ForeignKey(AggregationArea, on_delete=models.CASCADE)
+    zoom = models.PositiveSmallIntegerField()
+    geom = models.MultiPolygonField(srid=WEB_MERCATOR_SRID)
+
+    class Meta:
+        unique_together = ('aggregationarea', 'zoom')
+
+    def __str__(self):
+        return "{area} - zoom {zoom}".format(area=self.aggregationarea, zoom=self.zoom)
+
+
+class AggregationAreaTile(models.Model):
+    """
+    Raster tiles that intersect an aggregation area at a zoom level, flagged
+    as interior if the area covers the entire tile. Interior tiles are stored
+    at the lowest level where they are covered entirely, tiles on the area
+    boundary at the zoom level itself.
+    """
+    aggregationarea = models.ForeignKey(AggregationArea, on_delete=models.CASCADE)
+    zoom = models.PositiveSmallIntegerField()
+    tilez = models.PositiveSmallIntegerField()
+    tilex = models.IntegerField()
+    tiley = models.IntegerField()
+    interior = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('aggregationarea', 'zoom', 'tilez', 'tilex', 'tiley')
+
+    def __str__(self):
+        return "{area} - {z}/{x}/{y}".format(area=self.aggregationarea_id, z=self.tilez, x=self.tilex, y=self.tiley)
+
+
+class AggregationAreaCoverage(models.Model):
+    """
+    Range of tiles for which the tiles that cover an aggregation area at a
+    zoom level were computed. The coverage is computed when an area is
+    aggregated for the first time, clipped to the extent of the raster layers.
+    """
+    aggregationarea = models.ForeignKey(AggregationArea, on_delete=models.CASCADE)
+    zoom = models.PositiveSmallIntegerField()
+    xmin = models.IntegerField()
+    ymin = models.IntegerField()
+    xmax = models.IntegerField()
+    ymax = models.IntegerField()
+
+    class Meta:
+        unique_together = ('aggregationarea', 'zoom')
+
+    def __str__(self):
+        return "{area} - zoom {zoom}".format(area=self.aggregationarea_id, zoom=self.zoom)
+
+
+def coverage_tileranges(areas, layer_ids, zoom):
+    """
+    Get the tile ranges of a list of aggregation areas within the extent of a
+    set of raster layers at a zoom level, or None for areas that do not
+    overlap with the layers.
+    """
+    extents = [lyr.extent() for lyr in RasterLayer.objects.filter(id__in=layer_ids)]
+    if not extents:
+        return [None for area in areas]
+    bounds = (
+        min(extent[0] for extent in extents),
+        min(extent[1] for extent in extents),
+        max(extent[2] for extent in extents),
+        max(extent[3] for extent in extents),
+    )
+
+    tileranges = []
+    for area in areas:
+        xmin, ymin, xmax, ymax = area.geom.extent
+        xmin, ymin = max(xmin, bounds[0]), max(ymin, bounds[1])
+        xmax, ymax = min(xmax, bounds[2]), min(ymax, bounds[3])
+        if xmin > xmax or ymin > ymax:
+            tileranges.append(None)
+        else:
+            tileranges.append(list(tile_index_range((xmin, ymin, xmax, ymax), zoom)))
+    return tileranges
+
+
+def index_tile_coverages(areas, zoom, tileranges):
+    """
+    Compute and store the tiles that cover a list of aggregation areas at a
+    zoom level within a tile range per area, unless they were computed for a
+    range that contains it already.
+
+    The index of an area is extended to the bounding range of the indexed
+    and the requested ranges. Tiles that are indexed already are skipped, the
+    tiles are inserted in batches.
+    """
+    batch_size = getattr(settings, 'RASTER_AGGREGATION_PARSE_BATCH_SIZE', PARSE_BATCH_SIZE)
+    indexed = {
+        coverage.aggregationarea_id: coverage
+        for coverage in AggregationAreaCoverage.objects.filter(
+            aggregationarea_id__in=[area.id for area in areas],
+            zoom=zoom,
+        )
+    }
+
+    for area, tilerange in zip(areas, tileranges):
+        if not tilerange:
+            continue
+        coverage = indexed.get(area.id)
+        if coverage:
+            extended = [
+                min(coverage.xmin, tilerange[0]),
+                min(coverage.ymin, tilerange[1]),
+                max(coverage.xmax, tilerange[2]),
+                max(coverage.ymax, tilerange[3]),
+            ]
+            if extended == [coverage.xmin, coverage.ymin, coverage.xmax, coverage.ymax]:
+                continue
+            tilerange = extended
+
+        batch = []
+        for tile in area.build_tile_coverage(zoom, tilerange):
+            batch.append(tile)
+            if len(batch) >= batch_size:
+                AggregationAreaTile.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        AggregationAreaTile.objects.bulk_create(batch, ignore_conflicts=True)
+
+        AggregationAreaCoverage.objects.update_or_create(
+            aggregationarea_id=area.id,
+            zoom=zoom,
+            defaults=dict(zip(('xmin', 'ymin', 'xmax', 'ymax'), tilerange)),
+        )
+
+
+def tile_coverages(areas, zoom, tileranges):
+    """
+    Get the tiles that cover a list of aggregation areas at a zoom level
+    within a tile range per area. The coverage of areas that were not indexed
+    for the range yet is computed and stored. Returns one dictionary per area
+    that maps the tile indices to True for interior tiles and to False for
+    tiles on the area boundary.
+    """
+    index_tile_coverages(areas, zoom, tileranges)
+
+    coverages = [{} for area in areas]
+    ranges = {area.id: (label, tilerange) for label, (area, tilerange) in enumerate(zip(areas, tileranges)) if tilerange}
+    if not ranges:
+        return coverages
+
+    # Only read the tiles that overlap with the bounding range of all areas.
+    xmin = min(tilerange[0] for label, tilerange in ranges.values())
+    ymin = min(tilerange[1] for label, tilerange in ranges.values())
+    xmax = max(tilerange[2] for label, tilerange in ranges.values())
+    ymax = max(tilerange[3] for label, tilerange in ranges.values())
+    overlaps = Q()
+    for tilez in range(zoom + 1):
+        shift = zoom - tilez
+        overlaps |= Q(
+            tilez=tilez,
+            tilex__gte=xmin >> shift,
+            tilex__lte=xmax >> shift,
+            tiley__gte=ymin >> shift,
+            tiley__lte=ymax >> shift,
+        )
+    tiles = AggregationAreaTile.objects.filter(overlaps, aggregationarea_id__in=list(ranges), zoom=zoom)
+
+    # Resolve interior tiles of lower levels to the tiles at the zoom level.
+    for area_id, tilez, tilex, tiley, interior in tiles.values_list(
+            'aggregationarea_id', 'tilez', 'tilex', 'tiley', 'interior'):
+        label, tilerange = ranges[area_id]
+        factor = 2 ** (zoom - tilez)
+        for x in range(max(tilex * factor, tilerange[0]), min((tilex + 1) * factor - 1, tilerange[2]) + 1):
+            for y in range(max(tiley * factor, tilerange[1]), min((tiley + 1) * factor - 1, tilerange[3]) + 1):
+                coverages[label][(x, y)] = interior
+    return coverages
+
+
+# Key of the advisory lock that serializes the admission of value counts.
+ADMISSION_LOCK_ID = 7240531
+
+
+class ValueCountResultQuerySet(models.QuerySet):
+
+    def revalidate(self, statuses=None):
+        """
+        Mark the outdated results in this queryset as scheduled and return
+        their ids. Rows locked by a concurrent revalidation are skipped, so
+        that every outdated result is scheduled only once. Results with other
+        statuses can be revalidated by passing a list of statuses.
+        """
+        if statuses is None:
+            statuses = (ValueCountResult.OUTDATED, )
+
+        with transaction.atomic():
+            ids = list(
+                self.filter(status__in=statuses).select_for_update(
+                    skip_locked=True, of=('self', ),
+                ).values_list('id', flat=True)
+            )
+            ValueCountResult.objects.filter(id__in=ids).update(status=ValueCountResult.SCHEDULED)
+        return ids
+
+    def claim(self):
+        """
+        Mark the results in this queryset that are not computed or computing
+        as computing and return their ids. Computing results whose lease has
+        expired are claimed again, their worker is assumed to have crashed.
+        Results that were outdated while they are computed are not claimed
+        until the lease has ended, they are scheduled again by their worker.
+
+        The claimed results share a new lease token, only the worker with
+        the token can store the results.
+        """
+        expired = Q(lease_expires__isnull=True) | Q(lease_expires__lt=timezone.now())
+
+        with transaction.atomic():
+            ids = list(
+                self.filter(expired).exclude(status=ValueCountResult.FINISHED).select_for_update(
+                    skip_locked=True, of=('self', ),
+                ).values_list('id', flat=True)
+            )
+            ValueCountResult.objects.filter(id__in=ids).update(
+                status=ValueCountResult.COMPUTING,
+                lease_expires=ValueCountResult.lease_expiry(),
+                lease_token=uuid.uuid4(),
+            )
+        return ids
+
+    def finish(self, results, fields):
+        """
+        Store the fields and the status of claimed results and release their
+        leases. Only the columns of the fields are written, and only if the
+        results are still computing under the lease token of the instances.
+        Results that were claimed again after their lease expired are not
+        changed. Results that were outdated while they were computed are
+        released and scheduled again.
+        """
+        if not results:
+            return
+        tokens = set(result.lease_token for result in results if result.lease_token)
+        ids = [result.id for result in results]
+        for result in results:
+            result.lease_expires = None
+            result.lease_token = None
+
+        ValueCountResult.objects.filter(status=ValueCountResult.COMPUTING, lease_token__in=tokens).bulk_update(
+            results,
+            list(fields) + ['status', 'lease_expires', 'lease_token'],
+            batch_size=getattr(settings, 'RASTER_AGGREGATION_PARSE_BATCH_SIZE', PARSE_BATCH_SIZE),
+        )
+
+        stale = ValueCountResult.objects.filter(id__in=ids, lease_token__in=tokens)
+        stale_ids = list(stale.values_list('id', flat=True))
+        if not stale_ids:
+            return
+        stale.update(lease_expires=None, lease_token=None)
+        ids = ValueCountResult.objects.filter(id__in=stale_ids).revalidate(
+            statuses=(ValueCountResult.OUTDATED, ValueCountResult.SCHEDULED),
+        )
+        if ids:
+            # Avoid a circular import, the tasks module depends on the models.
+            from raster_aggregation.tasks import schedule_value_count_results
+            schedule_value_count_results(ids)
+
+    def admit(self, costs, budget=None):
+        """
+        Claim the results in this queryset if their estimated costs fit into
+        the budget next to the costs of the results that are being computed.
+        Returns the claimed ids, or None if the results have to wait.
+
+        Admissions are serialized across workers by an advisory lock. Results
+        are always admitted if nothing is being computed, so that results
+        larger than the budget are computed eventually.
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [ADMISSION_LOCK_ID])
+
+            if budget:
+                running = ValueCountResult.objects.filter(
+                    lease_expires__gte=timezone.now(),
+                ).aggregate(cost=Sum('cost'))['cost']
+                if running and running + sum(costs.values()) > budget:
+                    return None
+
+            ids = self.claim()
+            if ids:
+                # Record the costs of all claimed results in one statement.
+                ValueCountResult.objects.filter(id__in=ids).update(cost=Case(
+                    *[When(id=pk, then=Value(costs.get(pk))) for pk in ids],
+                    output_field=models.BigIntegerField()
+                ))
+        return ids
+
+    def renew_leases(self, factor=1):
+        """
+        Extend the leases of the results in this queryset that are being
+        computed. Leases are never shortened.
+        """
+        expiry = ValueCountResult.lease_expiry(factor)
+        self.filter(
+            Q(lease_expires__isnull=True) | Q(lease_expires__lt=expiry),
+            status=ValueCountResult.COMPUTING,
+        ).update(lease_expires=expiry)
+
+    def rollup(self, group_by=None):
+        """
+        Merge the value counts and statistics of the finished results in this
+        queryset in the database. Returns a dictionary with the summed value
+        counts, the number of merged results and the combined statistics.
+
+        If group_by is an attribute key of the aggregation areas, the results
+        are merged per attribute value and a list with one dictionary per
+        group is returned.
+        """
+        if group_by:
+            group = KeyTransform(group_by, 'aggregationarea__attributes')
+        else:
+            group = Value(None, output_field=models.TextField())
+
+        results = self.filter(status=ValueCountResult.FINISHED).annotate(
+            rollup_group=group,
+        ).values(
+            'value', 'stats_min', 'stats_max', 'stats_cumsum_t0',
+            'stats_cumsum_t1', 'stats_cumsum_t2', 'rollup_group',
+        )
+        try:
+            sql, params = results.query.sql_with_params()
+        except EmptyResultSet:
+            # The queryset can not match any results.
+            rows = []
+        else:
+            sql = """
+                WITH results AS ({results})
+                SELECT stats.rollup_group, stats.nr, stats.t0, stats.t1, stats.t2, stats.min, stats.max, counts.value
+                FROM (
+                    SELECT rollup_group, COUNT(*) AS nr, MIN(stats_min) AS min, MAX(stats_max) AS max,
+                        SUM(stats_cumsum_t0) AS t0, SUM(stats_cumsum_t1) AS t1, SUM(stats_cumsum_t2) AS t2
+                    FROM results GROUP BY rollup_group
+                ) AS stats
+                LEFT JOIN (
+                    SELECT rollup_group, json_object_agg(key, total) AS value
+                    FROM (
+                        SELECT rollup_group, kv.key, SUM(kv.count::double precision) AS total
+                        FROM results, each(results.value) AS kv(key, count)
+                        GROUP BY rollup_group, kv.key
+                    ) AS totals
+                    GROUP BY rollup_group
+                ) AS counts ON counts.rollup_group IS NOT DISTINCT FROM stats.rollup_group
+                ORDER BY stats.rollup_group
+            """.format(results=sql)
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+
+        if group_by:
+            return [self._rollup_row(*row) for row in rows]
+
+        rollup = self._rollup_row(*rows[0]) if rows else self._rollup_row(None, 0, None, None, None, None, None, None)
+        del rollup['group']
+        return rollup
+
+    def mixed(self):
+        """
+        Check if the finished results in this queryset were computed with
+        different parameters, their value counts can not be merged then.
+        """
+        combinations = self.filter(status=ValueCountResult.FINISHED).order_by().values(
+            'formula', 'layer_names', 'zoom', 'units', 'grouping', 'range_min', 'range_max',
+        ).distinct()
+        return combinations[:2].count() > 1
+
+    def mergeable(self):
+        """
+        Check if the value counts of the finished results in this queryset
+        can be merged, see ValueCountResult.mergeable. The results are
+        expected to share their parameters.
+        """
+        result = self.filter(status=ValueCountResult.FINISHED).first()
+        return result is None or result.mergeable()
+
+    @staticmethod
+    def _rollup_row(group, nr, t0, t1, t2, stats_min, stats_max, value):
+        """
+        Combine the mean and standard deviation from the total sums.
+        """
+        if t0:
+            avg = t1 / t0
+            std = math.sqrt(max(t0 * t2 - t1 * t1, 0)) / t0
+        else:
+            avg = None
+            std = None
+        return {
+            'group': group,
+            'results': nr,
+            'value': value or {},
+            'min': stats_min,
+            'max': stats_max,
+            'avg': avg,
+            'std': std,
+            'pcount': t0,
+            'psum': t1,
+            'psumsq': t2,
+        }
+
+
+def lease_heartbeat(valuecount_ids):
+    """
+    Return a function that extends the leases of the given results while
+    they are computed. It is meant to be called for every tile and renews
+    the leases at most once per tenth of the lease time.
+    """
+    renewed = [time.time()]
+
+    def heartbeat():
+        lease = getattr(settings, 'RASTER_AGGREGATION_VALUE_COUNT_LEASE', VALUE_COUNT_LEASE)
+        if time.time() - renewed[0] < lease / 10.0:
+            return
+        renewed[0] = time.time()
+        ValueCountResult.objects.filter(id__in=valuecount_ids).renew_leases()
+
+    return heartbeat
 
 
 class ValueCountResult(models.Model):
@@ -164,6 +851,19 @@ class ValueCountResult(models.Model):
     stats_cumsum_t1 = models.FloatField(editable=False, blank=True, null=True, help_text='Sum of pixel values.')
     stats_cumsum_t2 = models.FloatField(editable=False, blank=True, null=True, help_text='Sum of squares of pixel values.')
 
+    cost = models.BigIntegerField(editable=False, blank=True, null=True, help_text='Estimated number of pixels to compute.')
+    lease_expires = models.DateTimeField(editable=False, blank=True, null=True, help_text='Time until which the computation of the result is claimed.')
+    lease_token = models.UUIDField(editable=False, blank=True, null=True, help_text='Identifies the claim of the worker that computes the result.')
+    accessed = models.DateTimeField(editable=False, blank=True, null=True, db_index=True, help_text='Last time the result was read.')
+
+    objects = ValueCountResultQuerySet.as_manager()
+
+    # Fields that hold the computed value counts and statistics.
+    RESULT_FIELDS = [
+        'value', 'stats_min', 'stats_max', 'stats_avg', 'stats_std',
+        'stats_cumsum_t0', 'stats_cumsum_t1', 'stats_cumsum_t2',
+    ]
+
     class Meta:
         unique_together = (
             'aggregationarea', 'formula', 'layer_names', 'zoom', 'units', 'grouping',
@@ -172,59 +872,333 @@ class ValueCountResult(models.Model):
     def __str__(self):
         return "{id} - {area}".format(id=self.id, area=self.aggregationarea.name)
 
+    @staticmethod
+    def lease_expiry(factor=1):
+        """
+        Time until which a result that starts computing now is claimed, the
+        lease time can be multiplied by a factor.
+        """
+        lease = getattr(settings, 'RASTER_AGGREGATION_VALUE_COUNT_LEASE', VALUE_COUNT_LEASE)
+        return timezone.now() + datetime.timedelta(seconds=lease * factor)
+
+    def renew_lease(self, factor=1):
+        """
+        Extend the lease of this result if it is still being computed.
+        """
+        ValueCountResult.objects.filter(id=self.id).renew_leases(factor)
+
+    @property
+    def hist_range(self):
+        """
+        Range for valuecounts if both cutoff limits are provided.
+        """
+        if self.range_min is not None and self.range_max is not None:
+            return (self.range_min, self.range_max)
+
+    def estimate(self):
+        """
+        Estimate the number of tiles, pixels and bytes that are read to
+        compute this result.
+        """
+        return estimate_value_count(self.aggregationarea.geom, self.layer_names.values(), self.zoom)
+
+    def mergeable(self):
+        """
+        Aggregates of parts of an area can be merged unless the values are
+        grouped in histograms with data dependent bins.
+        """
+        if self.hist_range:
+            return True
+        if self.grouping == 'continuous':
+            return False
+        if self.grouping == 'auto':
+            return not RasterLayer.objects.filter(id__in=self.layer_names.values()).exclude(
+                datatype__in=(RasterLayer.CATEGORICAL, RasterLayer.MASK),
+            ).exists()
+        return True
+
+    def subdivide(self):
+        """
+        Split the tile range of this result into blocks of tiles if the
+        estimated number of pixels of the area exceeds the subdivision
+        threshold. Returns a list of tile ranges that intersect the area, or
+        a list with None if the area is not split.
+
+        Each tile belongs to exactly one block, so the aggregates of the blocks
+        add up to the aggregate of the entire area.
+        """
+        geom = self.aggregationarea.geom
+        threshold = getattr(settings, 'RASTER_AGGREGATION_SUBDIVIDE_PIXELS', SUBDIVIDE_PIXELS)
+        if not threshold or self.zoom is None:
+            return [None]
+        if self.estimate()['pixels'] <= threshold or not self.mergeable():
+            return [None]
+
+        # Use square blocks of tiles that hold about the threshold of pixels.
+        tilesize = int(getattr(settings, 'RASTER_TILESIZE', WEB_MERCATOR_TILESIZE))
+        block = max(1, int(math.sqrt(threshold)) // tilesize)
+        xmin, ymin, xmax, ymax = tile_index_range(geom.extent, self.zoom)
+        prepared = geom.prepared
+
+        tileranges = []
+        for tilex in range(xmin, xmax + 1, block):
+            for tiley in range(ymin, ymax + 1, block):
+                tilerange = [tilex, tiley, min(tilex + block - 1, xmax), min(tiley + block - 1, ymax)]
+                bounds = tile_bounds(tilex, tiley, self.zoom)
+                bounds_end = tile_bounds(tilerange[2], tilerange[3], self.zoom)
+                bbox = Polygon.from_bbox((bounds[0], bounds_end[1], bounds_end[2], bounds[3]))
+                bbox.srid = geom.srid
+                if prepared.intersects(bbox):
+                    tileranges.append(tilerange)
+
+        return tileranges
+
+    def aggregate(self, tilerange=None):
+        """
+        Compute the value counts and statistics with the parameters of this
+        result, optionally restricted to a range of tiles. Returns a
+        dictionary that can be merged with the aggregates of other ranges.
+        """
+        agg = CachedAggregator(
+            layer_dict=self.layer_names,
+            formula=self.formula,
+            zoom=self.zoom,
+            geom=self.aggregationarea.geom,
+            acres=self.units.lower() == 'acres',
+            grouping=self.grouping,
+            hist_range=self.hist_range,
+            mask_key=(self.aggregationarea.id, self.aggregationarea.fingerprint),
+            heartbeat=lease_heartbeat([self.id]),
+        )
+        if tilerange and agg.tilerange:
+            agg.tilerange = [
+                max(agg.tilerange[0], tilerange[0]),
+                max(agg.tilerange[1], tilerange[1]),
+                min(agg.tilerange[2], tilerange[2]),
+                min(agg.tilerange[3], tilerange[3]),
+            ]
+        # The tile range of the aggregator is clipped to the raster layers.
+        if agg.tilerange and agg.tilerange[0] <= agg.tilerange[2] and agg.tilerange[1] <= agg.tilerange[3]:
+            agg.coverage = self.aggregationarea.tile_coverage(self.zoom, agg.tilerange)
+        value = agg.value_count()
+        stats_min, stats_max, avg, std = agg.statistics()
+
+        # Convert numpy scalars to plain numbers.
+        return {
+            'value': {k: getattr(v, 'item', lambda: v)() for k, v in value.items()},
+            'min': None if stats_min is None else float(stats_min),
+            'max': None if stats_max is None else float(stats_max),
+            't0': float(agg._stats_t0),
+            't1': float(agg._stats_t1),
+            't2': float(agg._stats_t2),
+        }
+
+    @staticmethod
+    def merge_aggregates(aggregates):
+        """
+        Sum the value counts and cumulative statistics of a list of aggregates.
+        """
+        merged = {'value': {}, 'min': None, 'max': None, 't0': 0, 't1': 0, 't2': 0}
+        for aggregate in aggregates:
+            for key, count in aggregate['value'].items():
+                merged['value'][key] = merged['value'].get(key, 0) + count
+            for key in ('t0', 't1', 't2'):
+                merged[key] += aggregate[key]
+            if aggregate['min'] is not None:
+                merged['min'] = aggregate['min'] if merged['min'] is None else min(merged['min'], aggregate['min'])
+            if aggregate['max'] is not None:
+                merged['max'] = aggregate['max'] if merged['max'] is None else max(merged['max'], aggregate['max'])
+        return merged
+
+    def apply_aggregate(self, aggregate):
+        """
+        Store an aggregate on this result and mark it as finished.
+        """
+        # Convert values to string for storage in hstore
+        self.value = {k: str(v) for k, v in aggregate['value'].items()}
+        self.stats_min = aggregate['min']
+        self.stats_max = aggregate['max']
+
+        # Track cumulative data to be able to generalize stats over
+        # multiple aggregation areas.
+        self.stats_cumsum_t0 = aggregate['t0']
+        self.stats_cumsum_t1 = aggregate['t1']
+        self.stats_cumsum_t2 = aggregate['t2']
+
+        t0, t1, t2 = aggregate['t0'], aggregate['t1'], aggregate['t2']
+        if t0:
+            self.stats_avg = t1 / t0
+            self.stats_std = math.sqrt(max(t0 * t2 - t1 * t1, 0)) / t0
+        else:
+            self.stats_avg = None
+            self.stats_std = None
+
+        self.status = self.FINISHED
+        self.created = timezone.now()
+        self.lease_expires = None
+
+    def store(self, aggregate):
+        """
+        Store the aggregate of a claimed result, or mark it as failed if the
+        aggregate is None. See ValueCountResultQuerySet.finish.
+        """
+        if aggregate is None:
+            self.status = self.FAILED
+            fields = []
+        else:
+            self.apply_aggregate(aggregate)
+            fields = self.RESULT_FIELDS + ['created']
+        ValueCountResult.objects.finish([self], fields)
+
+    def compute(self):
+        """
+        Compute and store a claimed result.
+        """
+        try:
+            aggregate = self.aggregate()
+        except:
+            aggregate = None
+        self.store(aggregate)
+
     def populate(self, save=True):
         """
-        Compute value count using the objects value count parameters.
+        Compute value count using the objects value count parameters. The
+        result is claimed by this process while it is computed.
         """
         # Update status
         self.status = self.COMPUTING
+        self.lease_expires = self.lease_expiry()
+        self.lease_token = uuid.uuid4()
         if save:
             self.save()
-
-        # Compute range for valuecounts if provided.
-        if self.range_min is not None and self.range_max is not None:
-            hist_range = (self.range_min, self.range_max)
-        else:
-            hist_range = None
+            self.compute()
+            return
 
         try:
             # Compute aggregate result.
-            agg = Aggregator(
-                layer_dict=self.layer_names,
-                formula=self.formula,
-                zoom=self.zoom,
-                geom=self.aggregationarea.geom,
-                acres=self.units.lower() == 'acres',
-                grouping=self.grouping,
-                hist_range=hist_range,
-            )
-            aggregation_result = agg.value_count()
-            self.stats_min, self.stats_max, self.stats_avg, self.stats_std = agg.statistics()
+            self.apply_aggregate(self.aggregate())
+        except:
+            self.status = self.FAILED
+            self.lease_expires = None
+        self.lease_token = None
 
-            # Track cumulative data to be able to generalize stats over
-            # multiple aggregation areas.
-            self.stats_cumsum_t0 = agg._stats_t0
-            self.stats_cumsum_t1 = agg._stats_t1
-            self.stats_cumsum_t2 = agg._stats_t2
 
-            # Convert values to string for storage in hstore
-            self.value = {k: str(v) for k, v in aggregation_result.items()}
+class RasterLayerVersion(models.Model):
+    """
+    Version of the tiles of a rasterlayer, increased whenever it was parsed.
+    Processes compare it with the version of the tiles they have cached.
+    """
+    rasterlayer = models.OneToOneField(RasterLayer, on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(default=0)
 
-            self.status = self.FINISHED
-        except:
-            self.status = self.FAILED
+    def __str__(self):
+        return "{lyr} - version {version}".format(lyr=self.rasterlayer_id, version=self.version)
 
-        if save:
-            self.save()
+
+class RasterTileDigest(models.Model):
+    """
+    Digests of the raster tiles of a rasterlayer at its highest zoom level,
+    used to detect which tiles changed when the rasterlayer is parsed again.
+    """
+    rasterlayer = models.ForeignKey(RasterLayer, on_delete=models.CASCADE)
+    tilez = models.PositiveSmallIntegerField()
+    tilex = models.IntegerField()
+    tiley = models.IntegerField()
+    digest = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = ('rasterlayer', 'tilez', 'tilex', 'tiley')
+
+    def __str__(self):
+        return "{lyr} - {z}/{x}/{y}".format(lyr=self.rasterlayer_id, z=self.tilez, x=self.tilex, y=self.tiley)
+
+
+def update_raster_tile_digests(rasterlayer):
+    """
+    Compare the tiles of a rasterlayer with the digests stored after its
+    previous parse and store the new digests. Returns the region covered by
+    added, removed or changed tiles, or None if the tiles can not be compared.
+    """
+    zoom = rasterlayer.metadata.max_zoom if hasattr(rasterlayer, 'metadata') else None
+    if zoom is None:
+        RasterTileDigest.objects.filter(rasterlayer=rasterlayer).delete()
+        return
+
+    params = {
+        'tile': RasterTile._meta.db_table,
+        'digest': RasterTileDigest._meta.db_table,
+    }
+    changed_sql = """
+        WITH current AS (
+            SELECT tilez, tilex, tiley, md5(rast::bytea) AS digest
+            FROM {tile} WHERE rasterlayer_id = %s AND tilez = %s
+        ), stored AS (
+            SELECT tilez, tilex, tiley, digest
+            FROM {digest} WHERE rasterlayer_id = %s
+        )
+        SELECT tilez, tilex, tiley
+        FROM current FULL OUTER JOIN stored USING (tilez, tilex, tiley)
+        WHERE current.digest IS DISTINCT FROM stored.digest
+    """.format(**params)
+    store_sql = """
+        INSERT INTO {digest} (rasterlayer_id, tilez, tilex, tiley, digest)
+        SELECT rasterlayer_id, tilez, tilex, tiley, md5(rast::bytea)
+        FROM {tile} WHERE rasterlayer_id = %s AND tilez = %s
+    """.format(**params)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(changed_sql, [rasterlayer.id, zoom, rasterlayer.id])
+        changed = cursor.fetchall()
+        RasterTileDigest.objects.filter(rasterlayer=rasterlayer).delete()
+        cursor.execute(store_sql, [rasterlayer.id, zoom])
+
+    if not changed:
+        return Polygon(srid=WEB_MERCATOR_SRID)
+
+    region = MultiPolygon(
+        [Polygon.from_bbox(tile_bounds(tilex, tiley, tilez)) for tilez, tilex, tiley in changed],
+        srid=WEB_MERCATOR_SRID,
+    )
+    return region.unary_union
+
+
+def invalidate_value_count_results(rasterlayer, region=None):
+    """
+    Mark the results that depend on a rasterlayer as outdated, only the ones
+    with areas intersecting the region if provided. Returns the ids of the
+    outdated results.
+    """
+    results = ValueCountResult.objects.filter(rasterlayers=rasterlayer)
+    if region is not None:
+        if region.empty:
+            return []
+        results = results.filter(aggregationarea__geom__intersects=region)
+
+    # Results are outdated in a single update, ids are only collected if
+    # the results are computed again.
+    if not getattr(settings, 'RASTER_AGGREGATION_REQUEUE_OUTDATED', REQUEUE_OUTDATED):
+        results.update(status=ValueCountResult.OUTDATED)
+        return []
+
+    with transaction.atomic():
+        ids = list(results.select_for_update(of=('self', )).values_list('id', flat=True))
+        ValueCountResult.objects.filter(id__in=ids).update(status=ValueCountResult.OUTDATED)
+    return ids
 
 
 @receiver(rasterlayers_parser_ended, sender=RasterLayer)
 def remove_aggregation_results_after_rasterlayer_change(sender, instance, **kwargs):
     """
-    Update the status of ValueCountResults that depend on the rasterlayer that was changed.
+    Update the status of ValueCountResults that depend on the tiles of the
+    rasterlayer that changed.
     """
-    instance.valuecountresult_set.update(status=ValueCountResult.OUTDATED)
-    ValueCountResult.objects.filter(rasterlayers=instance).update(status=ValueCountResult.OUTDATED)
+    tile_cache.invalidate(instance.id)
+    ids = invalidate_value_count_results(instance, update_raster_tile_digests(instance))
+
+    if ids:
+        # Avoid a circular import, the tasks module depends on the models.
+        from raster_aggregation.tasks import schedule_value_count_results
+        schedule_value_count_results(ids)
 
 
 @receiver(post_save, sender=Legend)
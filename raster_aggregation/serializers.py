@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 
 import numpy
 from rest_framework import serializers
+from rest_framework_gis.fields import GeometrySerializerMethodField
 from rest_framework_gis.serializers import GeoFeatureModelSerializer
 
 from raster_aggregation.models import AggregationArea, AggregationLayer, ValueCountResult
@@ -19,11 +20,16 @@ class AggregationAreaSimplifiedSerializer(AggregationAreaSerializer):
     geom = serializers.SerializerMethodField()
 
     def get_geom(self, obj):
+        # Use the geometry for the requested zoom level if available
+        geom = getattr(obj, 'geom_zoom', None)
+        if geom is None:
+            geom = obj.geom_simplified
+
         # Transform geom to WGS84
-        obj.geom_simplified.transform(4326)
+        geom.transform(4326)
 
         # Get coordinates and round to 4 digits
-        coords = obj.geom_simplified.coords
+        coords = geom.coords
         coords = [
             [numpy.around(numpy.array(y), 4) for y in x] for x in coords
         ]
@@ -36,11 +42,18 @@ class AggregationAreaSimplifiedSerializer(AggregationAreaSerializer):
 
 class AggregationAreaGeoSerializer(GeoFeatureModelSerializer):
 
+    geom_simplified = GeometrySerializerMethodField()
+
     class Meta:
         model = AggregationArea
         geo_field = 'geom_simplified'
         fields = ('id', 'name', 'aggregationlayer')
 
+    def get_geom_simplified(self, obj):
+        # Use the geometry for the requested zoom level if available
+        geom = getattr(obj, 'geom_zoom', None)
+        return obj.geom_simplified if geom is None else geom
+
 
 class ValueCountResultSerializer(serializers.ModelSerializer):
 
@@ -55,13 +68,14 @@ class ValueCountResultSerializer(serializers.ModelSerializer):
     pcount = serializers.FloatField(source='stats_cumsum_t0', read_only=True)
     psum = serializers.FloatField(source='stats_cumsum_t1', read_only=True)
     psumsq = serializers.FloatField(source='stats_cumsum_t2', read_only=True)
+    stale = serializers.SerializerMethodField()
 
     class Meta:
         model = ValueCountResult
         fields = (
             'id', 'aggregationarea', 'rasterlayers', 'formula', 'layer_names',
             'zoom', 'units', 'grouping', 'value', 'created', 'status',
-            'min', 'max', 'avg', 'std', 'pcount', 'psum', 'psumsq',
+            'min', 'max', 'avg', 'std', 'pcount', 'psum', 'psumsq', 'stale',
         )
         read_only_fields = ('id', 'value', 'created', 'status', 'rasterlayers',)
 
@@ -71,6 +85,24 @@ class ValueCountResultSerializer(serializers.ModelSerializer):
         """
         return {str(k): float(v) for k, v in obj.value.items()}
 
+    def get_stale(self, obj):
+        """
+        The value is stale if it is served while it is outdated or computed
+        again.
+        """
+        return obj.status != obj.FINISHED and bool(obj.value)
+
+
+class ValueCountEstimateSerializer(serializers.Serializer):
+    """
+    Parameters of a value count result for a cost estimate, without the
+    uniqueness validation of the result serializer.
+    """
+    aggregationarea = serializers.PrimaryKeyRelatedField(queryset=AggregationArea.objects.all())
+    layer_names = serializers.DictField(child=serializers.IntegerField())
+    formula = serializers.CharField(required=False)
+    zoom = serializers.IntegerField(default=-1)
+
 
 class AggregationLayerSerializer(serializers.ModelSerializer):
 
@@ -83,7 +115,7 @@ class AggregationLayerSerializer(serializers.ModelSerializer):
         model = AggregationLayer
         fields = (
             'id', 'name', 'description', 'min_zoom_level', 'max_zoom_level',
-            'nr_of_areas', 'shapefile', 'name_column',
+            'nr_of_areas', 'shapefile', 'name_column', 'id_column',
             'simplification_tolerance', 'parse_log', 'modified',
             'aggregationareas',
         )
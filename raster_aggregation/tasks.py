@@ -1,26 +1,48 @@
 from __future__ import unicode_literals
 
+import datetime
 import os
-import shutil
 import tempfile
+import time
 import traceback
+import uuid
 import zipfile
 
-from celery import task
+from celery import chord, current_app, task
+from celery.backends.base import DisabledBackend
 from raster.models import RasterLayer
 
+from django.conf import settings
 from django.contrib.gis.db.models import Extent
+from django.contrib.gis.db.models.functions import Area
 from django.contrib.gis.gdal import CoordTransform, DataSource, SpatialReference
 from django.contrib.gis.geos import Polygon
-from raster_aggregation.models import AggregationLayer, ValueCountResult
-from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygon
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from raster_aggregation.const import (
+    ADMISSION_RETRY_DELAY, BULK_CONCURRENCY, BULK_PRIORITY, BULK_QUEUE, BULK_RETRY_DELAY, DEFER_SIMPLIFICATION,
+    INTERACTIVE_PRIORITY, INTERACTIVE_QUEUE, MAX_RUNNING_PIXELS, PARSE_BATCH_SIZE, PARSE_SHARD_SIZE, SWEEP_MAX_PIXELS,
+    SWEEP_MAX_ROWS, SWEEP_MAX_SECONDS, SWEEP_RETRY_DELAY, VALUE_COUNT_CHUNK_SIZE, ZONAL
+)
+from raster_aggregation.masks import mask_cache
+from raster_aggregation.models import (
+    AggregationArea, AggregationAreaCoverage, AggregationAreaGeometry, AggregationAreaTile, AggregationLayer,
+    ValueCountResult, coverage_tileranges, index_tile_coverages, lease_heartbeat, tile_coverages
+)
+from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygons
+from raster_aggregation.zonal import ZonalAggregator
 
 
 @task()
-def aggregation_layer_parser(agglayer_id):
+def aggregation_layer_parser(agglayer_id, incremental=False):
     """
     This function pushes the shapefile data from the AggregationLayer
     into the AggregationArea table.
+
+    In incremental mode, only areas that changed are updated, new areas are
+    inserted and missing ones deleted. Value count results of unchanged areas
+    are kept.
     """
     # Get aggregation layer.
     agglayer = AggregationLayer.objects.get(id=agglayer_id)
@@ -28,42 +50,65 @@ def aggregation_layer_parser(agglayer_id):
     # Clean previous parse log
     agglayer.log('Started parsing Aggregation Layer {0}.'.format(agglayer.id), AggregationLayer.PROCESSING)
 
-    tmpdir = tempfile.mkdtemp()
+    # Get zipped shapefile from storage
+    try:
+        shapefilepath, tmpfile = get_shapefile_path(agglayer)
+    except:
+        agglayer.log('Error: Could not download file, aborted parsing.', AggregationLayer.FAILED)
+        return
+
+    try:
+        parse_shapefile(agglayer, shapefilepath, incremental)
+    finally:
+        # Write buffered messages, also if parsing failed.
+        agglayer.flush_log()
+        # Remove temporary copy of the zipfile
+        if tmpfile:
+            os.remove(tmpfile)
 
-    shapefilename = os.path.basename(agglayer.shapefile.name)
 
-    shapefilepath = os.path.join(tmpdir, shapefilename)
+def get_shapefile_path(agglayer):
+    """
+    Return a local path to the zipped shapefile of the aggregation layer and
+    the path to a temporary file that has to be removed after parsing, if any.
 
-    # Get zipped shapefile from storage
+    Files on local storage are used in place, other storages are copied to a
+    temporary file chunk by chunk.
+    """
+    try:
+        return agglayer.shapefile.path, None
+    except NotImplementedError:
+        pass
+
+    shapefile = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
     try:
-        # Access shapefile and store locally
-        shapefile = open(shapefilepath, 'wb')
         for chunk in agglayer.shapefile.chunks():
             shapefile.write(chunk)
         shapefile.close()
     except:
-        shutil.rmtree(tmpdir)
-        agglayer.log('Error: Could not download file, aborted parsing.', AggregationLayer.FAILED)
-        return
+        shapefile.close()
+        os.remove(shapefile.name)
+        raise
 
-    # Open and extract zipfile
-    try:
-        zf = zipfile.ZipFile(shapefilepath)
-        zf.extractall(tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
+    return shapefile.name, shapefile.name
+
+
+def parse_shapefile(agglayer, shapefilepath, incremental=False):
+    """
+    Create aggregation areas from a zipped shapefile. The archive is not
+    extracted, GDAL reads the features lazily through its zip virtual file
+    system.
+    """
+    # Check zipfile integrity
+    if not zipfile.is_zipfile(shapefilepath):
         agglayer.log('Error: Could not open zipfile, aborted parsing.', AggregationLayer.FAILED)
         return
 
-    # Remove zipfile
-    os.remove(shapefilepath)
-
     # Set shapefile as datasource for GDAL and get layer
     try:
-        ds = DataSource(tmpdir)
+        ds = DataSource('/vsizip/' + shapefilepath)
         lyr = ds[0]
     except:
-        shutil.rmtree(tmpdir)
         agglayer.log('Error: Failed to extract layer from shapefile, aborted parsing.', AggregationLayer.FAILED)
         return
 
@@ -76,93 +121,412 @@ def aggregation_layer_parser(agglayer_id):
         )
         return
 
+    # Check if id column exists
+    if agglayer.id_column and agglayer.id_column.lower() not in [field.lower() for field in lyr.fields]:
+        agglayer.log(
+            'Error: ID column "{0}" not found, aborted parsing. '
+            'Available columns: {1}'.format(agglayer.id_column, lyr.fields),
+            AggregationLayer.FAILED
+        )
+        return
+
     # Track all fields
     agglayer.fields = {name: field.__name__ for name, field in zip(lyr.fields, lyr.field_types)}
-    agglayer.save()
+    agglayer.save(update_fields=['fields', 'modified'])
 
     # Setup transformation to default ref system
     try:
         ct = CoordTransform(lyr.srs, SpatialReference(WEB_MERCATOR_SRID))
     except:
-        shutil.rmtree(tmpdir)
         agglayer.log('Error: Layer srs not specified, aborted parsing', AggregationLayer.FAILED)
         return
 
-    # Remove existing patches before re-creating them
-    agglayer.aggregationarea_set.all().delete()
+    # Remove existing warnings
+    agglayer.aggregationlayerwarning_set.all().delete()
+
+    # Compare features against the existing areas in incremental mode.
+    if incremental:
+        parse_features_incrementally(agglayer, lyr, ct)
+        finish_parsing(agglayer)
+        return
+
+    # Remove staged areas from previous parsing attempts. The new areas are
+    # staged next to the current ones, which are replaced after parsing.
+    AggregationArea.all_objects.filter(aggregationlayer=agglayer, active=False).delete()
+
+    # Split large layers into shards of features that are parsed in parallel.
+    shard_size = getattr(settings, 'RASTER_AGGREGATION_PARSE_SHARD_SIZE', PARSE_SHARD_SIZE)
+    nr_of_features = len(lyr)
+    if shard_size and nr_of_features > shard_size and chords_available():
+        # Fids of deleted records are skipped, the last shard parses all
+        # features up to the end of the layer.
+        starts = list(range(0, nr_of_features, shard_size))
+        shards = [
+            aggregation_layer_parser_shard.si(agglayer.id, start, start + shard_size if start != starts[-1] else None)
+            for start in starts
+        ]
+        agglayer.log('Parsing {0} features in {1} shards.'.format(nr_of_features, len(shards)))
+        chord(shards)(aggregation_layer_parser_finished.si(agglayer.id))
+        return
+
+    parse_features(agglayer, lyr, ct)
+
+    finish_parsing(agglayer, staged=True)
+
+
+def shard_features(lyr, start, stop):
+    """
+    Yield the features of a layer with fids from start up to stop, or up to
+    the end of the layer if stop is None. Missing fids are skipped, shapefiles
+    with deleted records do not have consecutive fids.
+    """
+    if stop is None:
+        for feat in lyr:
+            if feat.fid >= start:
+                yield feat
+        return
+
+    for fid in range(start, stop):
+        try:
+            feat = lyr[fid]
+        except IndexError:
+            continue
+        yield feat
+
+
+@task()
+def aggregation_layer_parser_shard(agglayer_id, start, stop):
+    """
+    Parse the features with fids from start up to stop of the shapefile of an
+    aggregation layer, or up to the end of the shapefile if stop is None.
+    """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+
+    try:
+        shapefilepath, tmpfile = get_shapefile_path(agglayer)
+    except:
+        agglayer.log('Error: Could not download file, aborted parsing.', AggregationLayer.FAILED)
+        raise
+
+    try:
+        lyr = DataSource('/vsizip/' + shapefilepath)[0]
+        ct = CoordTransform(lyr.srs, SpatialReference(WEB_MERCATOR_SRID))
+        parse_features(agglayer, shard_features(lyr, start, stop), ct)
+    except:
+        agglayer.log(
+            'Error: Failed to parse features {0} to {1}, aborted parsing.'.format(
+                start, 'end' if stop is None else stop - 1,
+            ),
+            AggregationLayer.FAILED,
+        )
+        raise
+    finally:
+        agglayer.flush_log()
+        if tmpfile:
+            os.remove(tmpfile)
+
+
+@task()
+def aggregation_layer_parser_finished(agglayer_id):
+    """
+    Finalize the parsing of an aggregation layer after all shards were parsed.
+    """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+    try:
+        finish_parsing(agglayer, staged=True)
+    finally:
+        agglayer.flush_log()
+
+
+def parse_features(agglayer, features, ct, existing=None):
+    """
+    Validate and transform the given shapefile features and store them as
+    aggregation areas. If a lookup of existing areas is provided, features
+    are matched against it and only changed or new areas are written.
+    """
+    # Aggregation areas are written to the database in batches.
+    batch_size = int(getattr(settings, 'RASTER_AGGREGATION_PARSE_BATCH_SIZE', PARSE_BATCH_SIZE))
+    batch = []
 
     # Loop through features
-    for feat in lyr:
+    for feat in features:
         # Get geometry and transform to WGS84
         try:
             wgsgeom = feat.geom
             wgsgeom.transform(ct)
         except:
-            agglayer.log('Warning: Failed to transform feature fid {0}\n'.format(feat.fid))
+            agglayer.log_warning('Warning: Failed to transform feature fid {0}\n'.format(feat.fid), feat.fid)
             continue
 
         try:
             # Ignore z-dim
             wgsgeom.coord_dim = 2
-
-            # Assure that feature is a valid multipolygon
-            geom = convert_to_multipolygon(wgsgeom.geos)
+            geom = wgsgeom.geos
         except:
-            agglayer.log(
+            agglayer.log_warning(
                 'Warning: Failed to convert feature fid {0} to'
-                ' multipolygon\n'.format(feat.fid)
+                ' multipolygon\n'.format(feat.fid),
+                feat.fid,
             )
             continue
 
+        # Construct attribute dict.
+        attrs = {field.name: field.value for field in feat}
+
+        # Add feature to batch
+        batch.append((feat.fid, feat.get(agglayer.name_column), attrs, geom))
+
+        if len(batch) >= batch_size:
+            create_aggregation_areas(agglayer, batch, existing)
+            batch = []
+
+    # Write remaining areas
+    if batch:
+        create_aggregation_areas(agglayer, batch, existing)
+
+    agglayer.flush_log()
+
+
+def parse_features_incrementally(agglayer, lyr, ct):
+    """
+    Update the areas of an aggregation layer with the features of a layer.
+    Areas are matched on the id column of the aggregation layer if specified,
+    or on the fingerprint of their geometry, name and attributes otherwise.
+    """
+    # Get lookup of existing areas by key. Areas with duplicate keys are
+    # matched one by one.
+    if agglayer.id_column:
+        key = 'attributes__' + id_column_name(agglayer, lyr.fields)
+    else:
+        key = 'fingerprint'
+    existing = {}
+    nr_of_existing = 0
+    for area_key, pk, fingerprint in agglayer.aggregationarea_set.order_by('id').values_list(key, 'id', 'fingerprint'):
+        existing.setdefault(area_key, []).append((pk, fingerprint))
+        nr_of_existing += 1
+
+    parse_features(agglayer, lyr, ct, existing)
+
+    # Remove areas that are not present anymore.
+    missing = [pk for matches in existing.values() for pk, fingerprint in matches]
+    batch_size = int(getattr(settings, 'RASTER_AGGREGATION_PARSE_BATCH_SIZE', PARSE_BATCH_SIZE))
+    for i in range(0, len(missing), batch_size):
+        AggregationArea.objects.filter(id__in=missing[i:i + batch_size]).delete()
+    mask_cache.invalidate(missing)
+
+    agglayer.log('Kept {0} and removed {1} existing aggregation areas.'.format(
+        nr_of_existing - len(missing),
+        len(missing),
+    ))
+
+
+def id_column_name(agglayer, fields):
+    """
+    Get the name of the id column of an aggregation layer as it is spelled in
+    a list of fields, the id column is matched case insensitively.
+    """
+    for field in fields:
+        if field.lower() == agglayer.id_column.lower():
+            return field
+    return agglayer.id_column
+
+
+def update_aggregation_areas(agglayer, areas, existing):
+    """
+    Update the changed ones from a list of (fid, AggregationArea) pairs and
+    return the new ones. Matched areas are removed from the existing areas
+    lookup. Value count results of changed areas are marked as outdated.
+    """
+    new = []
+    changed = []
+    for fid, area in areas:
+        if agglayer.id_column:
+            key = area.attributes.get(id_column_name(agglayer, area.attributes))
+            key = None if key is None else str(key)
+        else:
+            key = area.fingerprint
+
+        if not existing.get(key):
+            new.append((fid, area))
+            continue
+
+        pk, fingerprint = existing[key].pop(0)
+        if fingerprint != area.fingerprint:
+            area.id = pk
+            changed.append(area)
+
+    if changed:
+        with transaction.atomic():
+            AggregationArea.objects.bulk_update(
+                changed,
+                ['name', 'attributes', 'geom', 'geom_simplified', 'fingerprint'],
+            )
+            ValueCountResult.objects.filter(
+                aggregationarea_id__in=[area.id for area in changed],
+            ).update(status=ValueCountResult.OUTDATED)
+            AggregationAreaGeometry.objects.filter(
+                aggregationarea_id__in=[area.id for area in changed],
+            ).delete()
+            AggregationAreaCoverage.objects.filter(
+                aggregationarea_id__in=[area.id for area in changed],
+            ).delete()
+            AggregationAreaTile.objects.filter(
+                aggregationarea_id__in=[area.id for area in changed],
+            ).delete()
+        mask_cache.invalidate([area.id for area in changed])
+
+        agglayer.log('Updated {0} changed aggregation areas.'.format(len(changed)), buffered=True)
+
+    return new
+
+
+def activate_staged_areas(agglayer):
+    """
+    Replace the current areas of an aggregation layer with the staged ones in
+    a single transaction, readers see either the old or the new areas.
+    """
+    replaced = list(agglayer.aggregationarea_set.values_list('id', flat=True))
+    with transaction.atomic():
+        agglayer.aggregationarea_set.all().delete()
+        AggregationArea.all_objects.filter(aggregationlayer=agglayer, active=False).update(active=True)
+    mask_cache.invalidate(replaced)
+
+
+def finish_parsing(agglayer, staged=False):
+    """
+    Simplify the areas if this was deferred, build the geometry pyramid,
+    activate the staged areas if required, count the number of shapes and
+    extent of this layer and finish parsing.
+    """
+    if defer_simplification():
+        agglayer.log('Simplifying aggregation areas.', buffered=True)
+        agglayer.simplify_areas(missing_only=True)
+
+    agglayer.build_geometry_pyramid()
+
+    if staged:
+        activate_staged_areas(agglayer)
+
+    agglayer.nr_of_areas = agglayer.aggregationarea_set.all().count()
+    extent = agglayer.aggregationarea_set.aggregate(Extent('geom'))['geom__extent']
+    agglayer.extent = Polygon.from_bbox(extent)
+    agglayer.save(update_fields=['nr_of_areas', 'extent', 'modified'])
+
+    agglayer.log('Finished parsing Aggregation Layer {0}'.format(agglayer.id), AggregationLayer.FINISHED)
+
+
+def defer_simplification():
+    """
+    The parser leaves the simplified geometries empty and computes them in
+    the database after all features were written if this setting is enabled.
+    """
+    return getattr(settings, 'RASTER_AGGREGATION_DEFER_SIMPLIFICATION', DEFER_SIMPLIFICATION)
+
+
+def chords_available():
+    """
+    Chords require a result backend to track the state of the header tasks,
+    unless tasks are executed eagerly.
+    """
+    return current_app.conf.task_always_eager or not isinstance(current_app.backend, DisabledBackend)
+
+
+def create_aggregation_areas(agglayer, batch, existing=None):
+    """
+    Write a batch of (fid, name, attributes, geometry) features to the
+    database using a single insert. The geometries of the batch are repaired
+    together. If the bulk insert fails, the areas are created one by one to
+    isolate the failing features.
+    """
+    # Assure that the features are valid multipolygons
+    geoms = convert_to_multipolygons([geom for fid, name, attrs, geom in batch])
+
+    defer = defer_simplification()
+
+    areas = []
+    for feature, geom in zip(batch, geoms):
+        fid, name, attrs = feature[:3]
+
         # Add warning if geom is not valid
-        if geom.valid_reason != 'Valid Geometry':
-            agglayer.log(
+        if not geom.valid:
+            agglayer.log_warning(
                 'Warning: Found invalid geometry for'
-                ' feature fid {0}\n'.format(feat.fid)
+                ' feature fid {0}\n'.format(fid),
+                fid,
             )
             continue
 
         # If geom is empty, conversion was not successful, issue
         # warning and continue
         if geom.empty:
-            agglayer.log(
+            agglayer.log_warning(
                 'Warning: Failed to convert feature fid'
-                ' {0} to valid geometry\n'.format(feat.fid)
+                ' {0} to valid geometry\n'.format(fid),
+                fid,
             )
             continue
 
-        # Construct attribute dict.
-        attrs = {field.name: field.value for field in feat}
+        # Stage new areas, unless they are updated incrementally.
+        area = AggregationArea(
+            name=name,
+            aggregationlayer=agglayer,
+            geom=geom,
+            attributes=attrs,
+            active=existing is not None,
+        )
 
-        # Create aggregation area
+        # Compute simplified geometry and fingerprint, bulk create does not
+        # call the save method.
         try:
-            agglayer.aggregationarea_set.create(
-                name=feat.get(agglayer.name_column),
-                aggregationlayer=agglayer,
-                geom=geom,
-                attributes=attrs,
-            )
+            if not defer:
+                area.simplify()
+            area.update_fingerprint()
         except:
-            agglayer.log(
+            agglayer.log_warning(
                 'Warning: Failed to create AggregationArea '
-                'for feature fid {0}\n'.format(feat.fid)
+                'for feature fid {0}\n'.format(fid),
+                fid,
             )
+            continue
 
-    # Count the number of shapes and extent of this layer.
-    agglayer.nr_of_areas = agglayer.aggregationarea_set.all().count()
-    extent = agglayer.aggregationarea_set.aggregate(Extent('geom'))['geom__extent']
-    agglayer.extent = Polygon.from_bbox(extent)
-    agglayer.save()
+        areas.append((fid, area))
 
-    agglayer.log('Finished parsing Aggregation Layer {0}'.format(agglayer.id), AggregationLayer.FINISHED)
+    # Only write changed and new areas in incremental mode.
+    if existing is not None:
+        areas = update_aggregation_areas(agglayer, areas, existing)
 
-    # Remove tempdir with unzipped shapefile
-    shutil.rmtree(tmpdir)
+    try:
+        with transaction.atomic():
+            AggregationArea.objects.bulk_create([area for fid, area in areas])
+        created = len(areas)
+    except:
+        created = 0
+        for fid, area in areas:
+            try:
+                with transaction.atomic():
+                    area.save()
+                created += 1
+            except:
+                agglayer.log_warning(
+                    'Warning: Failed to create AggregationArea '
+                    'for feature fid {0}\n'.format(fid),
+                    fid,
+                )
 
+    agglayer.log('Created batch of {0} out of {1} aggregation areas.'.format(created, len(batch)), buffered=True)
 
-def compute_value_count_for_aggregation_layer(obj, layer_id, compute_area=True, grouping='auto'):
+
+def compute_value_count_for_aggregation_layer(obj, layer_id, compute_area=True, grouping='auto', zonal=None):
     """
     Precomputes value counts for a given aggregation area and a rasterlayer.
+    The results are created in bulk and computed by chunked subtasks. If zonal
+    is True, the value counts of the areas of a chunk are computed together in
+    a single pass over the raster tiles, so tiles shared by several areas are
+    read once per chunk of VALUE_COUNT_CHUNK_SIZE areas. Defaults to the
+    RASTER_AGGREGATION_ZONAL setting.
+
+    Returns the async result of the task that completes the value count if
+    chords are available.
     """
     rast = RasterLayer.objects.get(id=layer_id)
 
@@ -174,9 +538,13 @@ def compute_value_count_for_aggregation_layer(obj, layer_id, compute_area=True,
         return
 
     # Prepare parameters data for aggregator
-    ids = {'a': str(rast.id)}
-    formula = 'a'
-    zoom = rast._max_zoom
+    params = {
+        'formula': 'a',
+        'layer_names': {'a': str(rast.id)},
+        'zoom': rast._max_zoom,
+        'units': 'acres' if compute_area else '',
+        'grouping': grouping,
+    }
 
     # Open parse log
     obj.log(
@@ -184,41 +552,502 @@ def compute_value_count_for_aggregation_layer(obj, layer_id, compute_area=True,
         .format(agg=obj.id, rst=rast.id)
     )
 
-    for area in obj.aggregationarea_set.all():
-        obj.log('Computing Value Count for area {0} and raster {1}'.format(area.id, rast.id))
+    try:
+        result_ids = create_value_count_results(obj, rast, params)
+    except:
+        obj.log(
+            'ERROR: Failed to create value count results for '
+            'AggregationLayer {agg} and raster {rst}'.format(agg=obj.id, rst=rast.id),
+        )
+        obj.log(traceback.format_exc())
+        return
+
+    return schedule_value_count_results(
+        result_ids,
+        zonal=zonal,
+        callback=value_count_for_aggregation_layer_finished.si(obj.id, rast.id),
+        agglayer=obj,
+    )
+
 
-        try:
-            # Store result, this automatically creates value on save
-            result, created = ValueCountResult.objects.get_or_create(
-                aggregationarea=area,
-                formula=formula,
-                layer_names=ids,
-                zoom=zoom,
-                units='acres' if compute_area else '',
-                grouping=grouping
-            )
-            if created:
-                result.rasterlayers.add(layer_id)
-            compute_single_value_count_result.delay(result.id)
-        except:
-            obj.log(
-                'ERROR: Failed to compute value count for '
-                'area {0} and raster {1}'.format(area.id, rast.id)
-            )
-            obj.log(traceback.format_exc())
+def task_options(interactive=False):
+    """
+    Celery routing options for interactive work requested through the api,
+    or for bulk work on entire layers.
+    """
+    if interactive:
+        queue = getattr(settings, 'RASTER_AGGREGATION_INTERACTIVE_QUEUE', INTERACTIVE_QUEUE)
+        priority = getattr(settings, 'RASTER_AGGREGATION_INTERACTIVE_PRIORITY', INTERACTIVE_PRIORITY)
+    else:
+        queue = getattr(settings, 'RASTER_AGGREGATION_BULK_QUEUE', BULK_QUEUE)
+        priority = getattr(settings, 'RASTER_AGGREGATION_BULK_PRIORITY', BULK_PRIORITY)
 
-    obj.log(
+    options = {}
+    if queue:
+        options['queue'] = queue
+    if priority is not None:
+        options['priority'] = priority
+    return options
+
+
+# Key of the advisory locks that hold the bulk slots, the slot number is the
+# second part of the lock key.
+BULK_SLOT_LOCK_ID = 7240532
+
+# Bulk slots held by this process, advisory locks are reentrant within one
+# database session.
+held_bulk_slots = set()
+
+
+def acquire_bulk_slot():
+    """
+    Acquire one of the slots that limit the number of concurrent bulk tasks,
+    reserving the remaining workers for interactive work. Returns the number
+    of the slot, True if the concurrency is unlimited, or None if all slots
+    are taken.
+
+    Slots are session level advisory locks in the database, so that they are
+    shared by all workers and released when the connection of a worker that
+    crashed is closed.
+    """
+    concurrency = getattr(settings, 'RASTER_AGGREGATION_BULK_CONCURRENCY', BULK_CONCURRENCY)
+    if not concurrency:
+        return True
+
+    with connection.cursor() as cursor:
+        for slot in range(concurrency):
+            if slot in held_bulk_slots:
+                continue
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [BULK_SLOT_LOCK_ID, slot])
+            if cursor.fetchone()[0]:
+                held_bulk_slots.add(slot)
+                return slot
+
+
+def release_bulk_slot(slot):
+    if slot is True:
+        return
+    held_bulk_slots.discard(slot)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [BULK_SLOT_LOCK_ID, slot])
+
+
+def schedule_value_count_results(result_ids, zonal=None, callback=None, agglayer=None, interactive=False):
+    """
+    Compute value count results in chunks of subtasks. The callback task is
+    executed after all chunks were computed if chords are available, and
+    right away otherwise. Returns the async result of the callback if it
+    was scheduled in a chord.
+
+    Zonal chunks compute their results in one pass over the raster tiles,
+    the scope of the shared tile reads is a single chunk. Whether chunks are
+    zonal defaults to the RASTER_AGGREGATION_ZONAL setting.
+
+    The subtasks are routed to the interactive or the bulk queue.
+    """
+    if zonal is None:
+        zonal = getattr(settings, 'RASTER_AGGREGATION_ZONAL', ZONAL)
+    options = task_options(interactive)
+    chunk_size = getattr(settings, 'RASTER_AGGREGATION_VALUE_COUNT_CHUNK_SIZE', VALUE_COUNT_CHUNK_SIZE)
+    chunk_task = compute_zonal_value_count_results if zonal else compute_value_count_results
+    chunks = [
+        chunk_task.si(result_ids[start:start + chunk_size], bulk=not interactive).set(**options)
+        for start in range(0, len(result_ids), chunk_size)
+    ]
+    if callback:
+        callback = callback.set(**options)
+
+    if agglayer:
+        agglayer.log('Computing {0} value counts in {1} chunks.'.format(len(result_ids), len(chunks)))
+
+    if chunks and callback and chords_available():
+        return chord(chunks)(callback)
+
+    for chunk in chunks:
+        chunk.delay()
+    if callback:
+        callback.delay()
+
+
+@task()
+def schedule_value_count_for_aggregation_layer(agglayer_id, layer_id, compute_area=True, grouping='auto', zonal=None):
+    """
+    Schedule the value counts for an aggregation layer and a rasterlayer.
+    The zonal engine is used if zonal is True or, by default, if the
+    RASTER_AGGREGATION_ZONAL setting is enabled.
+    Returns the id of the task that completes the value counts, if any.
+    """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+    try:
+        result = compute_value_count_for_aggregation_layer(agglayer, layer_id, compute_area, grouping, zonal)
+    finally:
+        agglayer.flush_log()
+    if result is not None:
+        return result.id
+
+
+def create_value_count_results(agglayer, rast, params):
+    """
+    Create the missing value count results with the given parameters for all
+    areas of an aggregation layer and return the ids of all its results. The
+    results and their raster layer relations are written with one insert each.
+    """
+    results = ValueCountResult.objects.filter(aggregationarea__aggregationlayer=agglayer, **params)
+    existing = set(results.values_list('aggregationarea_id', flat=True))
+
+    batch_size = getattr(settings, 'RASTER_AGGREGATION_PARSE_BATCH_SIZE', PARSE_BATCH_SIZE)
+    through = ValueCountResult.rasterlayers.through
+
+    with transaction.atomic():
+        ValueCountResult.objects.bulk_create(
+            [
+                ValueCountResult(aggregationarea_id=area_id, **params)
+                for area_id in agglayer.aggregationarea_set.values_list('id', flat=True)
+                if area_id not in existing
+            ],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+        result_ids = list(results.values_list('id', flat=True))
+        through.objects.bulk_create(
+            [through(valuecountresult_id=result_id, rasterlayer_id=rast.id) for result_id in result_ids],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+
+    return result_ids
+
+
+@task(bind=True)
+def compute_value_count_results(self, valuecount_ids, bulk=False):
+    """
+    Computes value counts for a chunk of results one by one. Bulk chunks are
+    retried later if all bulk slots are taken, the remaining results of a
+    chunk are retried later if they exceed the budget of running pixels.
+    """
+    slot = acquire_bulk_slot() if bulk else True
+    if slot is None:
+        raise self.retry(countdown=getattr(settings, 'RASTER_AGGREGATION_BULK_RETRY_DELAY', BULK_RETRY_DELAY), max_retries=None)
+
+    try:
+        for index, valuecount_id in enumerate(valuecount_ids):
+            ids = admit_value_count_results([valuecount_id], always=self.request.called_directly)
+            if ids is None:
+                raise self.retry(
+                    args=(valuecount_ids[index:], ),
+                    kwargs={'bulk': bulk},
+                    countdown=getattr(settings, 'RASTER_AGGREGATION_ADMISSION_RETRY_DELAY', ADMISSION_RETRY_DELAY),
+                    max_retries=None,
+                )
+            if ids:
+                compute_claimed_value_count_result(valuecount_id, interactive=not bulk)
+    finally:
+        release_bulk_slot(slot)
+
+
+def admit_value_count_results(valuecount_ids, always=False):
+    """
+    Claim a set of results if their estimated number of pixels fits into the
+    budget of pixels that are computed at the same time. Returns the claimed
+    ids, or None if the results have to wait. With always, the results are
+    admitted regardless of the budget.
+    """
+    results = ValueCountResult.objects.filter(id__in=valuecount_ids)
+    budget = getattr(settings, 'RASTER_AGGREGATION_MAX_RUNNING_PIXELS', MAX_RUNNING_PIXELS)
+    if not budget:
+        return results.claim()
+
+    costs = {
+        vc.id: vc.estimate()['pixels']
+        for vc in results.exclude(status=ValueCountResult.FINISHED).select_related('aggregationarea')
+    }
+    return results.admit(costs, None if always else budget)
+
+
+@task()
+def value_count_for_aggregation_layer_finished(agglayer_id, layer_id):
+    """
+    Log the completion of the value counts of an aggregation layer.
+    """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+    agglayer.log(
         'Ended Value count for AggregationLayer {agg} '
-        'on RasterLayer {rst}'.format(agg=obj.id, rst=rast.id)
+        'on RasterLayer {rst}'.format(agg=agglayer_id, rst=layer_id)
     )
 
 
 @task()
-def compute_single_value_count_result(valuecount_id):
+def simplify_aggregation_layer(agglayer_id):
     """
-    Computes value counts for a given input set.
+    Recompute the simplified geometries of all areas of an aggregation layer
+    in the database.
+    """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+    agglayer.log('Simplifying aggregation areas with tolerance {0}.'.format(agglayer.simplification_tolerance))
+    agglayer.simplify_areas()
+    agglayer.log('Finished simplifying aggregation areas.')
+
+
+@task(bind=True)
+def compute_single_value_count_result(self, valuecount_id, interactive=False, parallel=True):
+    """
+    Computes value counts for a given input set. The task is retried later
+    if the result exceeds the budget of running pixels, unless it is called
+    directly.
+    """
+    # Claim the result, it is skipped if it is computed or being computed
+    # by another worker.
+    ids = admit_value_count_results([valuecount_id], always=self.request.called_directly)
+    if ids is None:
+        raise self.retry(
+            countdown=getattr(settings, 'RASTER_AGGREGATION_ADMISSION_RETRY_DELAY', ADMISSION_RETRY_DELAY),
+            max_retries=None,
+        )
+    if ids:
+        compute_claimed_value_count_result(valuecount_id, interactive, parallel)
+
+
+def compute_claimed_value_count_result(valuecount_id, interactive=False, parallel=True):
+    """
+    Compute a claimed result. Results for large areas are split into blocks
+    of tiles that are computed in parallel subtasks, or one after the other
+    if parallel is False.
+    """
+    vc = ValueCountResult.objects.get(id=valuecount_id)
+
+    tileranges = subdivide_value_count_result(vc)
+    if tileranges is None:
+        return
+    if len(tileranges) > 1:
+        compute_value_count_parts(vc, tileranges, interactive, parallel)
+    else:
+        vc.compute()
+
+
+def subdivide_value_count_result(vc):
+    """
+    Get the tile ranges of the parts of a claimed result. Returns None and
+    marks the result as failed if the subdivision failed.
+    """
+    try:
+        return vc.subdivide()
+    except:
+        vc.store(None)
+
+
+def compute_value_count_parts(vc, tileranges, interactive=False, parallel=True):
+    """
+    Compute the aggregates of a result for a list of tile ranges and merge
+    them into the result. The parts are computed in a chord if chords are
+    available.
+
+    The lease of the result covers two lease times while the first parts
+    wait to be computed, the parts renew the lease while they are computed.
+    The result fails if a part or the merge fails without returning, for
+    instance if its worker is killed. The tile coverage of the area is
+    indexed before the parts are dispatched, so that every part only reads
+    the covering tiles of its own range.
+    """
+    vc.renew_lease(factor=2)
+    index_tile_coverages(
+        [vc.aggregationarea],
+        vc.zoom,
+        coverage_tileranges([vc.aggregationarea], vc.layer_names.values(), vc.zoom),
+    )
+    if parallel and chords_available():
+        options = task_options(interactive)
+        parts = [compute_value_count_part.si(vc.id, tilerange).set(**options) for tilerange in tileranges]
+        lease_token = str(vc.lease_token)
+        merge = merge_value_count_parts.s(vc.id, lease_token).set(**options)
+        merge.on_error(fail_value_count_parts.si(vc.id, lease_token).set(**options))
+        chord(parts)(merge)
+    else:
+        aggregates = [compute_value_count_part(vc.id, tilerange) for tilerange in tileranges]
+        vc.store(None if None in aggregates else ValueCountResult.merge_aggregates(aggregates))
+
+
+@task()
+def compute_value_count_part(valuecount_id, tilerange):
+    """
+    Compute the aggregate of a result for a range of tiles. Returns None if
+    the computation failed.
+    """
+    try:
+        vc = ValueCountResult.objects.get(id=valuecount_id)
+        vc.renew_lease()
+        return vc.aggregate(tilerange)
+    except:
+        return None
+
+
+@task()
+def merge_value_count_parts(aggregates, valuecount_id, lease_token):
+    """
+    Merge the aggregates of the parts of a result into the result, which
+    fails if any of the parts failed. The result is only stored if it is
+    still claimed with the lease token of the parts.
+    """
+    vc = ValueCountResult.objects.get(id=valuecount_id)
+    vc.lease_token = uuid.UUID(lease_token)
+    vc.store(None if None in aggregates else ValueCountResult.merge_aggregates(aggregates))
+
+
+@task()
+def fail_value_count_parts(valuecount_id, lease_token):
+    """
+    Mark a subdivided result as failed and release its lease, called if the
+    chord of its parts failed.
     """
     vc = ValueCountResult.objects.get(id=valuecount_id)
-    # If this object was newly created, populate its value count asynchronously.
-    if vc.status not in (ValueCountResult.COMPUTING, ValueCountResult.FINISHED):
-        vc.populate()
+    vc.lease_token = uuid.UUID(lease_token)
+    vc.store(None)
+
+
+@task(bind=True)
+def compute_zonal_value_count_results(self, valuecount_ids, bulk=False):
+    """
+    Computes value counts for results that only differ in their aggregation
+    area, reading every raster tile once for all areas of the chunk. Falls
+    back to computing the results one by one if the zonal aggregation fails.
+    Bulk chunks are retried later if all bulk slots are taken, and chunks
+    are retried later if they exceed the budget of running pixels.
+    """
+    slot = acquire_bulk_slot() if bulk else True
+    if slot is None:
+        raise self.retry(countdown=getattr(settings, 'RASTER_AGGREGATION_BULK_RETRY_DELAY', BULK_RETRY_DELAY), max_retries=None)
+
+    try:
+        ids = admit_value_count_results(valuecount_ids, always=self.request.called_directly)
+        if ids is None:
+            raise self.retry(
+                countdown=getattr(settings, 'RASTER_AGGREGATION_ADMISSION_RETRY_DELAY', ADMISSION_RETRY_DELAY),
+                max_retries=None,
+            )
+        if ids:
+            compute_zonal_value_counts(ids)
+    finally:
+        release_bulk_slot(slot)
+
+
+def compute_zonal_value_counts(ids):
+    """
+    Compute a set of claimed results with the zonal aggregator.
+    """
+    results = list(ValueCountResult.objects.filter(id__in=ids).select_related('aggregationarea'))
+
+    # Large areas are split into parts instead of being aggregated zonally.
+    remaining = []
+    for result in results:
+        tileranges = subdivide_value_count_result(result)
+        if tileranges is None:
+            continue
+        if len(tileranges) > 1:
+            compute_value_count_parts(result, tileranges)
+        else:
+            remaining.append(result)
+    results = remaining
+    if not results:
+        return
+
+    first = results[0]
+    areas = [result.aggregationarea for result in results]
+    try:
+        agg = ZonalAggregator(
+            layer_dict=first.layer_names,
+            formula=first.formula,
+            geoms=[result.aggregationarea.geom for result in results],
+            zoom=first.zoom,
+            acres=first.units.lower() == 'acres',
+            grouping=first.grouping,
+            hist_range=first.hist_range,
+            coverages=tile_coverages(areas, first.zoom, coverage_tileranges(areas, first.layer_names.values(), first.zoom)),
+            mask_keys=[(result.aggregationarea.id, result.aggregationarea.fingerprint) for result in results],
+            heartbeat=lease_heartbeat([result.id for result in results]),
+        )
+        values = agg.value_counts()
+    except:
+        for result in results:
+            result.compute()
+        return
+
+    now = timezone.now()
+    for result, fields in zip(results, values):
+        for key, value in fields.items():
+            setattr(result, key, value)
+        result.status = ValueCountResult.FINISHED
+        result.created = now
+
+    ValueCountResult.objects.finish(results, list(values[0].keys()) + ['created'])
+
+
+@task()
+def sweep_value_count_results(max_rows=None, max_pixels=None, max_seconds=None):
+    """
+    Compute outdated and failed value count results again, the most recently
+    read and smallest results first. Failed results are only retried after
+    a delay.
+
+    The number of results and their estimated number of pixels are limited
+    by budgets. With a time budget, the results are computed by this task
+    until the time is up, leaving the rest for the next run. Otherwise they
+    are queued for the regular value count subtasks.
+    """
+    if max_rows is None:
+        max_rows = getattr(settings, 'RASTER_AGGREGATION_SWEEP_MAX_ROWS', SWEEP_MAX_ROWS)
+    if max_pixels is None:
+        max_pixels = getattr(settings, 'RASTER_AGGREGATION_SWEEP_MAX_PIXELS', SWEEP_MAX_PIXELS)
+    if max_seconds is None:
+        max_seconds = getattr(settings, 'RASTER_AGGREGATION_SWEEP_MAX_SECONDS', SWEEP_MAX_SECONDS)
+    retry_delay = getattr(settings, 'RASTER_AGGREGATION_SWEEP_RETRY_DELAY', SWEEP_RETRY_DELAY)
+
+    started = time.time()
+
+    candidates = ValueCountResult.objects.filter(
+        Q(status=ValueCountResult.OUTDATED) | Q(
+            status=ValueCountResult.FAILED,
+            created__lt=timezone.now() - datetime.timedelta(seconds=retry_delay),
+        ),
+        # Results outdated while they are computed are scheduled again by
+        # their worker.
+        Q(lease_expires__isnull=True) | Q(lease_expires__lt=timezone.now()),
+    ).annotate(
+        area=Area('aggregationarea__geom'),
+    ).order_by(
+        F('accessed').desc(nulls_last=True), 'area', 'id',
+    ).select_related('aggregationarea')
+
+    # Select results within the row and pixel budgets.
+    ids = []
+    pixels = 0
+    for vc in candidates.iterator():
+        if max_rows and len(ids) >= max_rows:
+            break
+        if max_pixels:
+            estimate = vc.estimate()['pixels']
+            if ids and pixels + estimate > max_pixels:
+                break
+            pixels += estimate
+        ids.append(vc.id)
+
+    ids = ValueCountResult.objects.filter(id__in=ids).revalidate(
+        statuses=(ValueCountResult.OUTDATED, ValueCountResult.FAILED),
+    )
+
+    if not max_seconds:
+        schedule_value_count_results(ids)
+        return len(ids)
+
+    # Compute results until the time budget is used up, the remaining ones
+    # are outdated again to be picked up by the next run.
+    computed = 0
+    for pk in ids:
+        if time.time() - started > max_seconds:
+            break
+        compute_single_value_count_result(pk)
+        computed += 1
+    ValueCountResult.objects.filter(
+        id__in=ids[computed:],
+        status=ValueCountResult.SCHEDULED,
+    ).update(status=ValueCountResult.OUTDATED)
+
+    return computed
@@ -1,10 +1,17 @@
 from __future__ import unicode_literals
 
+import hashlib
+import json
+
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
-from django.db import connection
+from django.db import connection, transaction
 
 WEB_MERCATOR_SRID = 3857
 
+# SQL expression that simplifies a geometry column with a tolerance parameter
+# and ensures that the result is a valid multipolygon.
+SIMPLIFY_SQL = 'ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_SimplifyPreserveTopology({geom}, %s)), 3))'
+
 
 def convert_to_multipolygon(geom):
     """
@@ -50,6 +57,59 @@ def convert_to_multipolygon(geom):
         return geom
 
 
+def convert_to_multipolygons(geoms):
+    """
+    Convert a list of geometries into valid MultiPolygons. Valid polygons are
+    converted locally, all other geometries are repaired together in a single
+    query. Geometries that can not be repaired in bulk are converted one by one
+    using the convert_to_multipolygon function.
+    """
+    result = []
+    invalid = []
+    for geom in geoms:
+        if geom.empty or geom.area == 0:
+            # Points and lines can not be converted.
+            result.append(MultiPolygon([], srid=geom.srid))
+        elif geom.geom_type == 'MultiPolygon' and geom.valid:
+            result.append(geom)
+        elif geom.geom_type == 'Polygon' and geom.valid:
+            result.append(MultiPolygon(geom, srid=geom.srid))
+        else:
+            # Mark geometry for repair.
+            invalid.append(len(result))
+            result.append(None)
+
+    if not invalid:
+        return result
+
+    # Repair all invalid geometries at once, passing them as WKB.
+    sql = (
+        'SELECT ST_AsBinary(ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_GeomFromWKB(wkb)), 3))) '
+        'FROM unnest(%s::bytea[]) WITH ORDINALITY AS geoms(wkb, nr) ORDER BY nr'
+    )
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [[bytes(geoms[i].wkb) for i in invalid]])
+            repaired = [row[0] for row in cursor.fetchall()]
+    except:
+        repaired = [None] * len(invalid)
+
+    for i, wkb in zip(invalid, repaired):
+        srid = geoms[i].srid
+        if wkb is None:
+            # Fall back to iterative conversion if the bulk repair failed.
+            geom = convert_to_multipolygon(geoms[i])
+        else:
+            geom = GEOSGeometry(bytes(wkb), srid=srid)
+            if geom.empty or geom.area == 0:
+                geom = MultiPolygon([], srid=srid)
+            elif geom.geom_type != 'MultiPolygon' or not geom.valid:
+                geom = convert_to_multipolygon(geom)
+        result[i] = geom
+
+    return result
+
+
 def remove_sliver_polygons(geom, srid=WEB_MERCATOR_SRID, minarea_sqm=10):
     """Routine to remove sliver polygons from a multipolygon object"""
 
@@ -84,3 +144,14 @@ def distance_in_radians(point, distance, srid=WEB_MERCATOR_SRID):
     point_clone.transform(WEB_MERCATOR_SRID)
 
     return point.distance(point_clone)
+
+
+def area_fingerprint(geom, name, attributes):
+    """
+    Compute a hash of the geometry, name and attributes of an aggregation
+    area. Attribute values are hashed as strings, as they are stored in hstore.
+    """
+    attributes = {key: None if val is None else str(val) for key, val in attributes.items()}
+    fingerprint = hashlib.sha1(bytes(geom.wkb))
+    fingerprint.update(json.dumps([name, attributes], sort_keys=True, default=str).encode())
+    return fingerprint.hexdigest()
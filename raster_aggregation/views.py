@@ -5,23 +5,31 @@ from django_filters.rest_framework import DjangoFilterBackend
 from raster.models import RasterLayer
 from raster.tiles.const import WEB_MERCATOR_SRID
 from raster.tiles.utils import tile_bounds
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.mixins import CreateModelMixin, DestroyModelMixin, ListModelMixin, RetrieveModelMixin
+from rest_framework.response import Response
 from rest_framework_gis.filters import InBBOXFilter
 
 from django.contrib.gis.db.models.functions import Intersection
 from django.contrib.gis.gdal import OGRGeometry
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
-from raster_aggregation.exceptions import DuplicateError
+from django.utils import timezone
+from raster_aggregation.estimate import estimate_value_count, select_zoom
+from raster_aggregation.exceptions import (
+    DuplicateError, MissingQueryParameter, MixedResultsError, UnmergeableResultsError
+)
 from raster_aggregation.filters import ValueCountResultFilter
 from raster_aggregation.models import AggregationArea, AggregationLayer, ValueCountResult
 from raster_aggregation.serializers import (
     AggregationAreaGeoSerializer, AggregationAreaSimplifiedSerializer, AggregationLayerSerializer,
-    ValueCountResultSerializer
+    ValueCountEstimateSerializer, ValueCountResultSerializer
+)
+from raster_aggregation.tasks import (
+    compute_single_value_count_result, schedule_value_count_results, simplify_aggregation_layer, task_options
 )
-from raster_aggregation.tasks import compute_single_value_count_result
 
 
 class AggregationLayerViewSet(viewsets.ModelViewSet):
@@ -29,6 +37,22 @@ class AggregationLayerViewSet(viewsets.ModelViewSet):
     queryset = AggregationLayer.objects.all()
     serializer_class = AggregationLayerSerializer
 
+    def perform_update(self, serializer):
+        tolerance = serializer.instance.simplification_tolerance
+        super(AggregationLayerViewSet, self).perform_update(serializer)
+        # Recompute the simplified geometries if the tolerance changed.
+        if serializer.instance.simplification_tolerance != tolerance:
+            simplify_aggregation_layer.delay(serializer.instance.id)
+
+    @action(detail=True, methods=['post'])
+    def simplify(self, request, pk=None):
+        """
+        Recompute the simplified geometries of all areas of this layer.
+        """
+        agglayer = self.get_object()
+        simplify_aggregation_layer.delay(agglayer.id)
+        return Response(status=status.HTTP_202_ACCEPTED)
+
 
 class AggregationAreaViewSet(viewsets.ModelViewSet):
     """
@@ -39,6 +63,14 @@ class AggregationAreaViewSet(viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend, )
     filter_fields = ('aggregationlayer', )
 
+    def get_queryset(self):
+        queryset = super(AggregationAreaViewSet, self).get_queryset()
+        # Use the geometry pyramid if a zoom level was requested.
+        zoom = self.request.query_params.get('zoom', None)
+        if zoom:
+            queryset = queryset.annotate_zoom_geom(int(zoom), fallback='geom_simplified')
+        return queryset
+
 
 class ValueCountResultViewSet(CreateModelMixin,
                               RetrieveModelMixin,
@@ -53,42 +85,133 @@ class ValueCountResultViewSet(CreateModelMixin,
     filter_backends = (DjangoFilterBackend, )
     filter_class = ValueCountResultFilter
 
+    def revalidate(self, results):
+        """
+        Schedule the computation of outdated results, their stale values are
+        served until the new ones are available.
+        """
+        outdated = {result.id: result for result in results if result.status == ValueCountResult.OUTDATED}
+        if not outdated:
+            return
+
+        ids = ValueCountResult.objects.filter(id__in=outdated).revalidate()
+        for pk in ids:
+            outdated[pk].status = ValueCountResult.SCHEDULED
+        schedule_value_count_results(ids, interactive=True)
+
+    def track_access(self, results):
+        """
+        Store the time the results were read, recently read results are
+        computed first by the sweeper.
+        """
+        if results:
+            ValueCountResult.objects.filter(id__in=[result.id for result in results]).update(accessed=timezone.now())
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        self.track_access([instance])
+        self.revalidate([instance])
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = self.paginate_queryset(queryset)
+        results = list(queryset) if page is None else page
+        self.track_access(results)
+        self.revalidate(results)
+
+        serializer = self.get_serializer(results, many=True)
+        if page is None:
+            return Response(serializer.data)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False)
+    def rollup(self, request):
+        """
+        Merge the value counts and statistics of the filtered results, per
+        value of an area attribute if a group_by key is specified.
+        """
+        if 'formula' not in request.query_params:
+            raise MissingQueryParameter(detail='Specify the formula of the results to merge.')
+        queryset = self.filter_queryset(self.get_queryset())
+        if queryset.mixed():
+            raise MixedResultsError()
+        if not queryset.mergeable():
+            raise UnmergeableResultsError()
+        return Response(queryset.rollup(group_by=request.query_params.get('group_by')))
+
+    def get_zoom(self, serializer, rasterlayers):
+        """
+        Get zoom level, the serializer has a default to trick the validation. The
+        unique constraints on the model disable the required=False argument.
+        """
+        if serializer.validated_data.get('zoom') != -1:
+            return serializer.validated_data.get('zoom')
+
+        # Compute zoom if not provided, within the pixel budget if requested.
+        maxzoom = self.request.GET.get('maxzoom')
+        maxpixels = self.request.GET.get('maxpixels')
+        return select_zoom(
+            rasterlayers,
+            minmaxzoom='minmaxzoom' in self.request.GET,
+            maxzoom=int(maxzoom) if maxzoom else None,
+            geom=serializer.validated_data['aggregationarea'].geom,
+            max_pixels=int(maxpixels) if maxpixels else None,
+        )
+
+    @action(detail=False, methods=['post'])
+    def estimate(self, request):
+        """
+        Estimate the number of tiles, pixels and bytes that are read to compute
+        a value count result, without creating or computing it.
+        """
+        serializer = ValueCountEstimateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        rasterlayers = list(RasterLayer.objects.filter(id__in=serializer.validated_data['layer_names'].values()))
+        zoom = self.get_zoom(serializer, rasterlayers)
+        return Response(estimate_value_count(
+            serializer.validated_data['aggregationarea'].geom,
+            [rst.id for rst in rasterlayers],
+            zoom,
+        ))
+
     def perform_create(self, serializer):
         # Get list of rasterlayers based on layer names dict.
         rasterlayers = [RasterLayer.objects.get(id=pk) for pk in set(serializer.validated_data.get('layer_names').values())]
-
-        # Get zoom level, the serializer has a default to trick the validation. The
-        # unique constraints on the model disable the required=False argument.
-        if serializer.validated_data.get('zoom') != -1:
-            zoom = serializer.validated_data.get('zoom')
-        else:
-            # Compute zoom if not provided. Work at the resolution of the
-            # input layer with the highest zoom level by default, or the
-            # lowest one if requested.
-            zlevels = [rst.metadata.max_zoom for rst in rasterlayers]
-            if 'minmaxzoom' in self.request.GET:
-                # Get the minimum of maxzoom levels
-                zoom = min(zlevels)
-            elif 'maxzoom' in self.request.GET:
-                # Limit maximum zoom level
-                maxzoom = int(self.request.GET.get('maxzoom'))
-                zoom = min(max(zlevels), maxzoom)
-            else:
-                # Compute at the maximum maxzoom (resolution of highest definition layer)
-                zoom = max(zlevels)
+        zoom = self.get_zoom(serializer, rasterlayers)
 
         # Create object with final zoom value.
         try:
-            obj = serializer.save(zoom=zoom, rasterlayers=rasterlayers)
+            with transaction.atomic():
+                obj = serializer.save(zoom=zoom, rasterlayers=rasterlayers)
         except IntegrityError:
-            raise DuplicateError()
+            # Requesting an outdated result again refreshes it.
+            data = serializer.validated_data
+            obj = ValueCountResult.objects.filter(
+                aggregationarea=data['aggregationarea'],
+                formula=data['formula'],
+                layer_names=data['layer_names'],
+                zoom=zoom,
+                units=data.get('units', ''),
+                grouping=data.get('grouping', 'auto'),
+                status=ValueCountResult.OUTDATED,
+            ).first()
+            if obj is None:
+                raise DuplicateError()
+            serializer.instance = obj
+            # The result was already scheduled by a concurrent request.
+            if not ValueCountResult.objects.filter(id=obj.id).revalidate():
+                return
+            obj.status = ValueCountResult.SCHEDULED
 
         # Push value count task to queue.
         if 'synchronous' in self.request.GET:
-            compute_single_value_count_result(obj.id)
+            compute_single_value_count_result(obj.id, interactive=True, parallel=False)
             obj.refresh_from_db()
         else:
-            compute_single_value_count_result.delay(obj.id)
+            compute_single_value_count_result.apply_async((obj.id, True), **task_options(interactive=True))
 
 
 class AggregationAreaGeoViewSet(viewsets.ReadOnlyModelViewSet):
@@ -105,9 +228,10 @@ class AggregationAreaGeoViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         queryset = AggregationArea.objects.all()
-        zoom = self.request.QUERY_PARAMS.get('zoom', None)
+        zoom = self.request.query_params.get('zoom', None)
         if zoom:
             queryset = queryset.filter(aggregationlayer__min_zoom_level__lte=zoom, aggregationlayer__max_zoom_level__gte=zoom)
+            queryset = queryset.annotate_zoom_geom(int(zoom), fallback='geom_simplified')
         return queryset
 
 
@@ -131,14 +255,20 @@ class AggregationLayerVectorTilesViewSet(ListModelMixin, viewsets.GenericViewSet
         bounds_buffer = bounds.buffer((bounds_coords[2] - bounds_coords[0]) / 100)
 
         # Get the intersection of the aggregation areas and the tile boundary.
-        # use buffer to clip the aggregation area.
+        # use buffer to clip the aggregation area. The geometry pyramid level
+        # for this zoom level is used if available.
         result = AggregationArea.objects.filter(
             aggregationlayer=lyr,
             geom__intersects=bounds,
+        ).annotate_zoom_geom(
+            int(z),
         ).annotate(
-            intersection=Intersection('geom', bounds_buffer)
+            intersection=Intersection('geom_zoom', bounds_buffer)
         ).only('id', 'name', 'attributes')
 
+        # Skip areas that vanished through simplification.
+        result = [dat for dat in result if not dat.intersection.empty]
+
         # Render intersection as vector tile in two different available formats.
         if frmt == 'json':
             result = ['{{"geometry": {0}, "properties": {{"id": {1}, "name": "{2}"}}}}'.format(dat.intersection.geojson, dat.id, dat.name) for dat in result]
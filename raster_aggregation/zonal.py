@@ -0,0 +1,251 @@
+from __future__ import unicode_literals
+
+from collections import Counter, defaultdict
+
+import numpy
+from raster.algebra.parser import FormulaParser, RasterAlgebraParser
+from raster.exceptions import RasterAggregationException
+from raster.models import Legend
+from raster.rasterize import rasterize
+from raster.tiles.utils import tile_bounds, tile_index_range
+
+from django.contrib.gis.gdal import OGRGeometry
+from django.contrib.gis.geos import Polygon
+from raster_aggregation.cache import CachedAggregator
+from raster_aggregation.masks import mask_cache
+
+# Conversion factor from square meters to acres.
+ACRES_PER_SQUARE_METER = 0.000247105381
+
+
+class ZonalAggregator(CachedAggregator):
+    """
+    Compute value counts and statistics for many areas in a single pass over
+    the raster tiles.
+
+    Every tile is read and evaluated once. The pixels of all areas that
+    intersect the tile are collected into one value array with a label array
+    holding the index of the area for each pixel, the counts and statistics
+    are then computed for all labels at once. Areas may overlap, pixels that
+    fall into several areas are counted for each of them.
+
+    If the tile coverages of the areas are provided, the areas are grouped
+    by their covering tiles and interior tiles are not rasterized. With mask
+    keys of area ids and fingerprints, the masks of the boundary tiles are
+    read from the mask cache.
+    """
+
+    def __init__(self, layer_dict, formula, geoms, zoom=None, acres=True,
+                 grouping='auto', all_touched=True, hist_range=None, coverages=None, mask_keys=None,
+                 heartbeat=None):
+        super(ZonalAggregator, self).__init__(
+            layer_dict, formula, zoom=zoom, acres=acres, grouping=grouping,
+            all_touched=all_touched, hist_range=hist_range, heartbeat=heartbeat,
+        )
+        self.geoms = geoms
+        self.coverages = coverages
+        self.mask_keys = mask_keys
+
+        if self.grouping == 'continuous':
+            # Histogram bins have to be equal for all tiles.
+            if not self.hist_range:
+                raise RasterAggregationException(
+                    'Specify a histogram range for zonal continuous aggregation.'
+                )
+            self.bins = numpy.histogram([], range=self.hist_range)[1]
+        elif self.grouping != 'discrete':
+            # If input is not a legend, interpret input as legend json data
+            if not isinstance(self.grouping, Legend):
+                self.grouping = Legend(json=self.grouping)
+            try:
+                self.colormap = self.grouping.colormap
+            except:
+                raise RasterAggregationException(
+                    'Invalid grouping value found for valuecount.'
+                )
+
+    def labeled_tiles(self):
+        """
+        Generator that yields a (values, labels) pair of arrays for each tile
+        that intersects any of the areas, together with the list of labels of
+        the areas that were considered for the tile.
+        """
+        if not self.tilerange:
+            return
+
+        # Group the areas by their covering tiles, or by the tiles that their
+        # bounding boxes touch.
+        tiles = defaultdict(list)
+        if self.coverages is not None:
+            for label, coverage in enumerate(self.coverages):
+                for tilex, tiley in coverage:
+                    if self.tilerange[0] <= tilex <= self.tilerange[2] and self.tilerange[1] <= tiley <= self.tilerange[3]:
+                        tiles[(tilex, tiley)].append(label)
+        else:
+            for label, geom in enumerate(self.geoms):
+                xmin, ymin, xmax, ymax = tile_index_range(geom.extent, self.zoom)
+                for tilex in range(max(xmin, self.tilerange[0]), min(xmax, self.tilerange[2]) + 1):
+                    for tiley in range(max(ymin, self.tilerange[1]), min(ymax, self.tilerange[3]) + 1):
+                        tiles[(tilex, tiley)].append(label)
+
+        # Convert the geometries once instead of for every tile.
+        prepared = [geom.prepared for geom in self.geoms]
+        ogr_geoms = [OGRGeometry(geom.ewkt) for geom in self.geoms]
+
+        algebra_parser = RasterAlgebraParser()
+
+        for (tilex, tiley), tile_labels in sorted(tiles.items()):
+            evaluated = self.evaluate_tile(algebra_parser, tilex, tiley)
+            if evaluated is None:
+                continue
+            result, result_data = evaluated
+            valid = ~numpy.ma.getmaskarray(result_data)
+            result_data = result_data.data
+
+            # Track pixel scale for the conversion to acres.
+            self.scale = result.scale
+
+            tile_geom = Polygon.from_bbox(tile_bounds(tilex, tiley, self.zoom))
+            values = []
+            labels = []
+            for label in tile_labels:
+                # Only rasterize areas that do not cover the entire tile.
+                if self.coverages is not None:
+                    interior = self.coverages[label][(tilex, tiley)]
+                else:
+                    interior = prepared[label].contains(tile_geom)
+                if interior:
+                    mask = valid
+                else:
+                    mask = valid & self.area_mask(label, result, ogr_geoms, tilex, tiley)
+
+                selected = result_data[mask]
+                values.append(selected)
+                labels.append(numpy.full(selected.size, label, dtype=numpy.intp))
+
+            yield numpy.concatenate(values), numpy.concatenate(labels), tile_labels
+
+    def area_mask(self, label, tile, ogr_geoms, tilex, tiley):
+        """
+        Boolean array of the pixels of a tile that are inside of an area.
+        """
+        def build():
+            rastgeom = rasterize(ogr_geoms[label], tile, all_touched=self.all_touched)
+            return rastgeom.bands[0].data() == 1
+
+        if self.mask_keys is None:
+            return build()
+        return mask_cache.get(self.mask_keys[label], self.zoom, tilex, tiley, self.all_touched, build)
+
+    def _count_pairs(self, labels, keys, inverse):
+        """
+        Add the number of pixels per label and key index to the counters.
+        """
+        pairs, counts = numpy.unique(labels * len(keys) + inverse, return_counts=True)
+        for pair, count in zip(pairs, counts):
+            self._counts[pair // len(keys)][keys[pair % len(keys)]] += count
+
+    def _push_zonal(self, values, labels):
+        size = len(self.geoms)
+
+        # Compute value counts per label.
+        if self.grouping == 'discrete':
+            keys, inverse = numpy.unique(values, return_inverse=True)
+            self._count_pairs(labels, keys, inverse)
+        elif self.grouping == 'continuous':
+            inside = (values >= self.bins[0]) & (values <= self.bins[-1])
+            # The last bin includes its upper edge, like numpy.histogram.
+            inverse = numpy.searchsorted(self.bins, values[inside], side='right') - 1
+            inverse = numpy.minimum(inverse, len(self.bins) - 2)
+            keys = [(self.bins[i], self.bins[i + 1]) for i in range(len(self.bins) - 1)]
+            self._count_pairs(labels[inside], keys, inverse)
+        else:
+            formula_parser = FormulaParser()
+            for key in self.colormap:
+                try:
+                    # Try to use the key as number directly
+                    selector = values == float(key)
+                except ValueError:
+                    # Otherwise use it as numpy expression directly
+                    selector = formula_parser.evaluate({'x': values}, key)
+                counted, counts = numpy.unique(labels[selector], return_counts=True)
+                for label, count in zip(counted, counts):
+                    self._counts[label][key] += count
+
+        # Filter data by histogram range.
+        if self.hist_range:
+            inside = (values >= self.hist_range[0]) & (values <= self.hist_range[1])
+            values = values[inside]
+            labels = labels[inside]
+
+        if not values.size:
+            return
+
+        # Compute incremental statistics per label.
+        values = values.astype('float64')
+        self._t0 += numpy.bincount(labels, minlength=size)
+        self._t1 += numpy.bincount(labels, weights=values, minlength=size)
+        self._t2 += numpy.bincount(labels, weights=numpy.square(values), minlength=size)
+        numpy.minimum.at(self._min, labels, values)
+        numpy.maximum.at(self._max, labels, values)
+
+    def value_counts(self):
+        """
+        Compute the value counts and statistics for all areas. Returns a list
+        with one dictionary of ValueCountResult field values per area.
+        """
+        size = len(self.geoms)
+        self.scale = None
+        self._counts = [Counter() for i in range(size)]
+        self._seen = numpy.zeros(size, dtype=bool)
+        self._t0 = numpy.zeros(size)
+        self._t1 = numpy.zeros(size)
+        self._t2 = numpy.zeros(size)
+        self._min = numpy.full(size, numpy.inf)
+        self._max = numpy.full(size, -numpy.inf)
+
+        for values, labels, tile_labels in self.labeled_tiles():
+            self._seen[tile_labels] = True
+            self._push_zonal(values, labels)
+
+        # Transform pixel count to acres if requested
+        scaling_factor = 1
+        if self.acres and self.scale:
+            scaling_factor = abs(self.scale.x * self.scale.y) * ACRES_PER_SQUARE_METER
+
+        # Areas that were covered by tiles report all bins and legend entries.
+        if self.grouping == 'continuous':
+            empty = {(self.bins[i], self.bins[i + 1]): 0 for i in range(len(self.bins) - 1)}
+        elif self.grouping == 'discrete':
+            empty = {}
+        else:
+            empty = {key: 0 for key in self.colormap}
+
+        results = []
+        for label in range(size):
+            counts = dict(empty) if self._seen[label] else {}
+            counts.update(self._counts[label])
+
+            t0 = self._t0[label]
+            if t0 == 0:
+                stats = (None, None, None, None)
+            else:
+                t1 = self._t1[label]
+                t2 = self._t2[label]
+                stats = (self._min[label], self._max[label], t1 / t0, numpy.sqrt(t0 * t2 - t1 * t1) / t0)
+
+            results.append({
+                'value': {
+                    str(int(k) if type(k) is numpy.float64 and int(k) == k else k): str(v * scaling_factor)
+                    for k, v in counts.items()
+                },
+                'stats_min': stats[0],
+                'stats_max': stats[1],
+                'stats_avg': stats[2],
+                'stats_std': stats[3],
+                'stats_cumsum_t0': t0,
+                'stats_cumsum_t1': self._t1[label],
+                'stats_cumsum_t2': self._t2[label],
+            })
+
+        return results
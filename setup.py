@@ -9,7 +9,12 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='django-raster-aggregation',
     version='0.2',
-    packages=['raster_aggregation', 'raster_aggregation.migrations'],
+    packages=[
+        'raster_aggregation',
+        'raster_aggregation.management',
+        'raster_aggregation.management.commands',
+        'raster_aggregation.migrations',
+    ],
     include_package_data=True,
     license='BSD',
     description='Zonal aggregation functionality for django-raster',
@@ -18,7 +23,7 @@ setup(
     author='Daniel Wiesmann',
     author_email='daniel@urbmet.com',
     install_requires=[
-        'Django>=2.0',
+        'Django>=2.2',
         'celery>=4.0.2',
         'django-raster>=0.5',
         'django-filter>=1.0.4',
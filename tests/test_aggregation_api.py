@@ -207,12 +207,96 @@ class RasterAggregationApiTests(RasterAggregationTestCase):
         # Value count was bounded by given zoom level
         self.assertEqual(result['zoom'], 3)
 
+    def test_aggregation_api_estimate(self):
+        url = reverse('valuecountresult-estimate')
+        response = self.client.post(url, json.dumps(self.data), format='json', content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.strip().decode())
+        self.assertEqual(result['zoom'], self.rasterlayer.metadata.max_zoom)
+        self.assertGreater(result['tiles'], 0)
+        self.assertEqual(result['pixels'], result['tiles'] * 256 ** 2)
+        self.assertGreater(result['bytes'], 0)
+        # The estimate does not create a result.
+        self.assertFalse(ValueCountResult.objects.filter(aggregationarea=self.area).exists())
+
+    def test_aggregation_api_estimate_mixed_resolutions(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            rasterlayer_low_res = RasterLayer.objects.create(
+                name='Raster data',
+                description='Second small raster for testing',
+                datatype='ca',
+                nodata=0,
+                max_zoom=3,
+                rasterfile=self.rasterfile
+            )
+        self.data['layer_names'] = {'a': self.rasterlayer.id, 'b': rasterlayer_low_res.id}
+
+        url = reverse('valuecountresult-estimate')
+        response = self.client.post(url, json.dumps(self.data), format='json', content_type='application/json')
+        result = json.loads(response.content.strip().decode())
+
+        # The low resolution layer is warped to the zoom level of the other.
+        self.assertEqual(result['zoom'], self.rasterlayer.metadata.max_zoom)
+        self.assertGreater(result['tiles'], 0)
+        self.assertGreater(result['bytes'], 0)
+
+    def test_aggregation_api_estimate_existing_result(self):
+        result = self._create_obj()
+        self.data['zoom'] = result['zoom']
+        url = reverse('valuecountresult-estimate')
+        response = self.client.post(url, json.dumps(self.data), format='json', content_type='application/json')
+        # Estimates for existing results are not rejected as duplicates.
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.strip().decode())['zoom'], result['zoom'])
+
+    def test_aggregation_api_count_maxpixels_parameter(self):
+        self.url += '?maxpixels=65536'
+        result = self._create_obj()
+
+        # The zoom level was reduced until the area fits into the budget.
+        vc = ValueCountResult.objects.get(id=result['id'])
+        self.assertLess(result['zoom'], self.rasterlayer.metadata.max_zoom)
+        self.assertLessEqual(vc.estimate()['pixels'], 65536)
+
     def test_aggregation_api_unique_constraint(self):
         self._create_obj()
         response = self.client.post(self.url, json.dumps(self.data), format='json', content_type='application/json')
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.content, b'{"detail":"A value count object with this properties already exists."}')
 
+    def test_aggregation_api_duplicate_refreshes_outdated_result(self):
+        result = self._create_obj()
+        ValueCountResult.objects.filter(id=result['id']).update(status=ValueCountResult.OUTDATED)
+
+        response = self.client.post(self.url, json.dumps(self.data), format='json', content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = json.loads(response.content.strip().decode())
+        self.assertEqual(response['id'], result['id'])
+        self.assertEqual(ValueCountResult.objects.get(id=result['id']).status, ValueCountResult.FINISHED)
+
+    def test_aggregation_api_serves_stale_results(self):
+        result = self._create_obj()
+        ValueCountResult.objects.filter(id=result['id']).update(status=ValueCountResult.OUTDATED)
+
+        # The stale value is served while the result is computed again.
+        url = reverse('valuecountresult-detail', kwargs={'pk': result['id']})
+        response = json.loads(self.client.get(url).content.strip().decode())
+        self.assertTrue(response['stale'])
+        self.assertEqual(response['status'], 'Scheduled')
+        self.assertEqual(response['value'], result['value'])
+
+        response = json.loads(self.client.get(url).content.strip().decode())
+        self.assertFalse(response['stale'])
+        self.assertEqual(response['status'], 'Finished')
+
+    def test_aggregation_api_list_revalidates_outdated_results(self):
+        result = self._create_obj()
+        ValueCountResult.objects.filter(id=result['id']).update(status=ValueCountResult.OUTDATED)
+
+        response = json.loads(self.client.get(self.url).content.strip().decode())
+        self.assertEqual([obj['stale'] for obj in response], [True])
+        self.assertEqual(ValueCountResult.objects.get(id=result['id']).status, ValueCountResult.FINISHED)
+
     def test_aggregation_api_synchronous(self):
         self.url += '?synchronous'
         result = self._create_obj()
@@ -1,7 +1,14 @@
 from __future__ import unicode_literals
 
-from raster_aggregation.models import ValueCountResult
-from raster_aggregation.tasks import aggregation_layer_parser, compute_value_count_for_aggregation_layer
+from raster.tiles.utils import tile_bounds
+
+from django.contrib.gis.geos import Polygon
+from django.core.management import call_command
+from django.utils import timezone
+from raster_aggregation.models import AggregationArea, RasterTileDigest, ValueCountResult
+from raster_aggregation.tasks import (
+    aggregation_layer_parser, compute_value_count_for_aggregation_layer, sweep_value_count_results
+)
 
 from .aggregation_testcase import RasterAggregationTestCase
 
@@ -22,9 +29,97 @@ class RasterAggregationInvalidationTests(RasterAggregationTestCase):
 
         self.assertEqual(ValueCountResult.objects.all().count(), 0)
 
+    def test_incremental_reparsing_keeps_results(self):
+        area_ids = set(self.agglayer.aggregationarea_set.values_list('id', flat=True))
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+
+        self.assertEqual(set(self.agglayer.aggregationarea_set.values_list('id', flat=True)), area_ids)
+        self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 2)
+
+    def test_incremental_reparsing_with_id_column(self):
+        self.agglayer.id_column = 'id'
+        self.agglayer.save(update_fields=['id_column'])
+
+        # Change an area, the reparse should restore it from the shapefile.
+        area = AggregationArea.objects.get(name='Coverall')
+        area.attributes['LongName'] = 'Changed'
+        area.save()
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+
+        area.refresh_from_db()
+        self.assertEqual(area.attributes['LongName'], 'An area that covers everything.')
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        self.assertEqual(ValueCountResult.objects.get(aggregationarea=area).status, ValueCountResult.OUTDATED)
+        self.assertEqual(ValueCountResult.objects.get(aggregationarea__name='St Petersburg').status, ValueCountResult.FINISHED)
+
+    def test_incremental_reparsing_with_id_column_in_other_case(self):
+        self.agglayer.id_column = 'ID'
+        self.agglayer.save(update_fields=['id_column'])
+        area_ids = set(self.agglayer.aggregationarea_set.values_list('id', flat=True))
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+
+        self.agglayer.refresh_from_db()
+        self.assertEqual(self.agglayer.status, self.agglayer.FINISHED)
+        self.assertEqual(set(self.agglayer.aggregationarea_set.values_list('id', flat=True)), area_ids)
+
+    def test_incremental_reparsing_removes_duplicate_areas(self):
+        area = AggregationArea.objects.get(name='St Petersburg')
+        duplicate = AggregationArea.objects.create(
+            name=area.name,
+            aggregationlayer=self.agglayer,
+            attributes=area.attributes,
+            geom=area.geom,
+        )
+        self.assertEqual(duplicate.fingerprint, area.fingerprint)
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        self.assertFalse(AggregationArea.objects.filter(id=duplicate.id).exists())
+        self.assertEqual(ValueCountResult.objects.get(aggregationarea=area).status, ValueCountResult.FINISHED)
+
+    def _reparse_rasterlayer(self):
+        # Clear parse log to trigger reparsing of rasterlayer.
+        with self.settings(MEDIA_ROOT=self.media_root):
+            self.rasterlayer.parsestatus.reset()
+            self.rasterlayer.save()
+
+    def test_reparsing_unchanged_rasterlayer_keeps_results(self):
+        self._reparse_rasterlayer()
+        self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 2)
+
+    def test_invalidation_of_areas_intersecting_changed_tiles(self):
+        # Change the digest of a tile that does not intersect St Petersburg.
+        area = AggregationArea.objects.get(name='St Petersburg')
+        for digest in RasterTileDigest.objects.filter(rasterlayer=self.rasterlayer):
+            if not Polygon.from_bbox(tile_bounds(digest.tilex, digest.tiley, digest.tilez)).intersects(area.geom):
+                digest.digest = ''
+                digest.save()
+                break
+
+        self._reparse_rasterlayer()
+
+        self.assertEqual(ValueCountResult.objects.get(aggregationarea__name='Coverall').status, ValueCountResult.OUTDATED)
+        self.assertEqual(ValueCountResult.objects.get(aggregationarea=area).status, ValueCountResult.FINISHED)
+
+    def test_requeue_outdated_results(self):
+        RasterTileDigest.objects.filter(rasterlayer=self.rasterlayer).delete()
+        with self.settings(RASTER_AGGREGATION_REQUEUE_OUTDATED=True):
+            self._reparse_rasterlayer()
+        self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 2)
+
     def test_invalidation_from_reparsing_rasterlayer(self):
         self.assertEqual(ValueCountResult.objects.all().count(), 2)
 
+        # Tiles without stored digest count as changed.
+        RasterTileDigest.objects.filter(rasterlayer=self.rasterlayer).delete()
+
         # Clear parse log to trigger reparsing of rasterlayer.
         with self.settings(MEDIA_ROOT=self.media_root):
             self.rasterlayer.parsestatus.reset()
@@ -43,3 +138,29 @@ class RasterAggregationInvalidationTests(RasterAggregationTestCase):
         self.legend_exp.save()
         self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 0)
         self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.OUTDATED).count(), 2)
+
+    def test_sweep_outdated_results(self):
+        ValueCountResult.objects.update(status=ValueCountResult.OUTDATED)
+        ValueCountResult.objects.filter(aggregationarea__name='Coverall').update(accessed=timezone.now())
+
+        # The most recently read result is computed first.
+        self.assertEqual(sweep_value_count_results(max_rows=1), 1)
+        self.assertEqual(ValueCountResult.objects.get(aggregationarea__name='Coverall').status, ValueCountResult.FINISHED)
+        self.assertEqual(ValueCountResult.objects.get(aggregationarea__name='St Petersburg').status, ValueCountResult.OUTDATED)
+
+        call_command('sweep_value_count_results', seconds=60)
+        self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 2)
+
+    def test_sweep_pixel_budget(self):
+        ValueCountResult.objects.update(status=ValueCountResult.OUTDATED)
+        # The first result is always computed, even if it exceeds the budget.
+        self.assertEqual(sweep_value_count_results(max_pixels=1), 1)
+        self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 1)
+
+    def test_sweep_waits_to_retry_failed_results(self):
+        ValueCountResult.objects.update(status=ValueCountResult.FAILED)
+        self.assertEqual(sweep_value_count_results(), 0)
+
+        with self.settings(RASTER_AGGREGATION_SWEEP_RETRY_DELAY=0):
+            self.assertEqual(sweep_value_count_results(), 2)
+        self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 2)
@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+
+import json
+
+from django.test import Client
+from django.urls import reverse_lazy as reverse
+from raster_aggregation.models import ValueCountResult
+from raster_aggregation.tasks import compute_value_count_for_aggregation_layer
+
+from .aggregation_testcase import RasterAggregationTestCase
+
+
+class RasterAggregationRollupTests(RasterAggregationTestCase):
+
+    def setUp(self):
+        super(RasterAggregationRollupTests, self).setUp()
+
+        compute_value_count_for_aggregation_layer(self.agglayer, self.rasterlayer.id, compute_area=False)
+
+        self.client = Client()
+        self.url = reverse('valuecountresult-rollup')
+
+    def test_rollup(self):
+        rollup = ValueCountResult.objects.all().rollup()
+
+        results = ValueCountResult.objects.all()
+        self.assertEqual(rollup['results'], 2)
+        self.assertEqual(rollup['pcount'], sum(result.stats_cumsum_t0 for result in results))
+        self.assertEqual(rollup['min'], min(result.stats_min for result in results))
+        self.assertEqual(rollup['max'], max(result.stats_max for result in results))
+        self.assertAlmostEqual(rollup['avg'], sum(result.stats_cumsum_t1 for result in results) / rollup['pcount'])
+
+        expected = {}
+        for result in results:
+            for key, value in result.value.items():
+                expected[key] = expected.get(key, 0) + float(value)
+        self.assertEqual(rollup['value'], expected)
+
+    def test_rollup_of_empty_queryset(self):
+        rollup = ValueCountResult.objects.none().rollup()
+        self.assertEqual(rollup['results'], 0)
+        self.assertEqual(rollup['value'], {})
+        self.assertIsNone(rollup['avg'])
+
+    def test_rollup_api(self):
+        response = self.client.get(self.url, {
+            'formula': 'a',
+            'aggregationarea__aggregationlayer': self.agglayer.id,
+            'attributes': json.dumps({'Name': 'Coverall'}),
+        })
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.strip().decode())
+
+        coverall = ValueCountResult.objects.get(aggregationarea__name='Coverall')
+        self.assertEqual(result['results'], 1)
+        self.assertEqual(result['value'], {k: float(v) for k, v in coverall.value.items()})
+        self.assertAlmostEqual(result['avg'], coverall.stats_avg)
+
+    def test_rollup_api_for_area_list(self):
+        ids = ValueCountResult.objects.values_list('aggregationarea_id', flat=True)
+        response = self.client.get(self.url, {'formula': 'a', 'aggregationareas': ','.join(str(pk) for pk in ids)})
+        self.assertEqual(json.loads(response.content.strip().decode())['results'], 2)
+
+    def test_rollup_api_requires_formula(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_rollup_api_without_matching_areas(self):
+        response = self.client.get(self.url, {'formula': 'a', 'aggregationareas': '0'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.strip().decode())['results'], 0)
+
+    def test_rollup_api_rejects_mixed_results(self):
+        ValueCountResult.objects.filter(aggregationarea__name='Coverall').update(units='acres')
+        response = self.client.get(self.url, {'formula': 'a'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(self.url, {'formula': 'a', 'units': 'acres'})
+        self.assertEqual(json.loads(response.content.strip().decode())['results'], 1)
+
+    def test_rollup_api_rejects_data_dependent_histograms(self):
+        ValueCountResult.objects.update(grouping='continuous')
+        response = self.client.get(self.url, {'formula': 'a'})
+        self.assertEqual(response.status_code, 400)
+
+        # Histograms with a fixed range can be merged.
+        ValueCountResult.objects.update(range_min=0, range_max=10)
+        response = self.client.get(self.url, {'formula': 'a'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rollup_by_attribute(self):
+        rollups = ValueCountResult.objects.all().rollup(group_by='Name')
+        self.assertEqual([rollup['group'] for rollup in rollups], ['Coverall', 'St Petersburg'])
+        for rollup in rollups:
+            result = ValueCountResult.objects.get(aggregationarea__name=rollup['group'])
+            self.assertEqual(rollup['results'], 1)
+            self.assertEqual(rollup['pcount'], result.stats_cumsum_t0)
+            self.assertEqual(rollup['value'], {k: float(v) for k, v in result.value.items()})
+
+    def test_rollup_api_by_attribute(self):
+        response = self.client.get(self.url, {'formula': 'a', 'group_by': 'LongName'})
+        result = json.loads(response.content.strip().decode())
+        self.assertEqual(len(result), 2)
+        self.assertEqual(sum(group['results'] for group in result), 2)
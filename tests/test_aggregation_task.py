@@ -1,7 +1,16 @@
 from __future__ import unicode_literals
 
-from raster_aggregation.models import ValueCountResult
-from raster_aggregation.tasks import compute_value_count_for_aggregation_layer
+import datetime
+import time
+import uuid
+
+from django.utils import timezone
+from raster_aggregation.models import ValueCountResult, lease_heartbeat
+from raster_aggregation.tasks import (
+    acquire_bulk_slot, compute_single_value_count_result, compute_value_count_for_aggregation_layer,
+    compute_zonal_value_count_results, fail_value_count_parts, release_bulk_slot,
+    schedule_value_count_for_aggregation_layer, task_options
+)
 
 from .aggregation_testcase import RasterAggregationTestCase
 
@@ -46,3 +55,196 @@ class RasterAggregationTaskTests(RasterAggregationTestCase):
         self.assertEqual(vc.stats_min, 2)
         self.assertEqual(vc.stats_max, 8)
         self.assertAlmostEqual(vc.stats_avg, 4.03124746, 1)
+
+    def assertZonalResultsEqual(self, results):
+        expected = {}
+        for vc in results:
+            expected[vc.id] = vc
+        ValueCountResult.objects.filter(id__in=expected).update(status=ValueCountResult.OUTDATED, value={})
+
+        compute_zonal_value_count_results(list(expected))
+
+        for vc in ValueCountResult.objects.filter(id__in=expected):
+            self.assertEqual(vc.status, ValueCountResult.FINISHED)
+            self.assertEqual(sorted(vc.value), sorted(expected[vc.id].value))
+            for key, value in vc.value.items():
+                self.assertAlmostEqual(float(value), float(expected[vc.id].value[key]))
+            for field in ('stats_min', 'stats_max', 'stats_avg', 'stats_std', 'stats_cumsum_t0', 'stats_cumsum_t1'):
+                self.assertAlmostEqual(getattr(vc, field), getattr(expected[vc.id], field))
+
+    def test_zonal_value_counts(self):
+        self.assertZonalResultsEqual(ValueCountResult.objects.all())
+
+    def test_zonal_value_counts_with_legend_and_acres(self):
+        compute_value_count_for_aggregation_layer(
+            self.agglayer, self.rasterlayer.id, compute_area=True, grouping=self.legend_exp.id,
+        )
+        self.assertZonalResultsEqual(ValueCountResult.objects.filter(units='acres'))
+
+    def test_zonal_value_counts_for_aggregation_layer(self):
+        ValueCountResult.objects.all().delete()
+        compute_value_count_for_aggregation_layer(self.agglayer, self.rasterlayer.id, compute_area=False, zonal=True)
+        result = ValueCountResult.objects.get(aggregationarea__name='Coverall')
+        self.assertEqual(result.status, ValueCountResult.FINISHED)
+        self.assertDictEqual({k: float(v) for k, v in result.value.items()}, self.expected)
+
+    def test_zonal_value_counts_from_setting(self):
+        ValueCountResult.objects.all().delete()
+        with self.settings(RASTER_AGGREGATION_ZONAL=True):
+            schedule_value_count_for_aggregation_layer(self.agglayer.id, self.rasterlayer.id, compute_area=False)
+        result = ValueCountResult.objects.get(aggregationarea__name='Coverall')
+        self.assertEqual(result.status, ValueCountResult.FINISHED)
+        self.assertDictEqual({k: float(v) for k, v in result.value.items()}, self.expected)
+
+    def test_value_count_results_are_created_once(self):
+        with self.settings(RASTER_AGGREGATION_VALUE_COUNT_CHUNK_SIZE=1):
+            compute_value_count_for_aggregation_layer(self.agglayer, self.rasterlayer.id, compute_area=False)
+
+        self.assertEqual(ValueCountResult.objects.all().count(), 2)
+        for result in ValueCountResult.objects.all():
+            self.assertEqual(list(result.rasterlayers.all()), [self.rasterlayer])
+
+        self.agglayer.refresh_from_db()
+        self.assertIn('Computing 2 value counts in 2 chunks.', self.agglayer.parse_log)
+        self.assertIn('Ended Value count for AggregationLayer', self.agglayer.parse_log)
+
+    def test_schedule_value_count_task(self):
+        ValueCountResult.objects.all().delete()
+        schedule_value_count_for_aggregation_layer.delay(self.agglayer.id, self.rasterlayer.id, compute_area=False)
+        self.assertEqual(ValueCountResult.objects.filter(status=ValueCountResult.FINISHED).count(), 2)
+
+    def test_claim_value_count_results(self):
+        ValueCountResult.objects.update(status=ValueCountResult.SCHEDULED)
+        ids = ValueCountResult.objects.all().claim()
+        self.assertEqual(len(ids), 2)
+
+        # Results that are being computed are not claimed again, they are not
+        # computed by the task either.
+        self.assertEqual(ValueCountResult.objects.all().claim(), [])
+        compute_single_value_count_result(ids[0])
+        self.assertEqual(ValueCountResult.objects.get(id=ids[0]).status, ValueCountResult.COMPUTING)
+
+        # Results with expired leases are claimed again.
+        ValueCountResult.objects.filter(id=ids[0]).update(lease_expires=timezone.now() - datetime.timedelta(seconds=1))
+        compute_single_value_count_result(ids[0])
+        result = ValueCountResult.objects.get(id=ids[0])
+        self.assertEqual(result.status, ValueCountResult.FINISHED)
+        self.assertIsNone(result.lease_expires)
+
+    def test_admit_value_count_results(self):
+        ValueCountResult.objects.update(status=ValueCountResult.SCHEDULED)
+        first, second = ValueCountResult.objects.order_by('id').values_list('id', flat=True)
+
+        # Results are admitted if nothing is running, even above the budget.
+        self.assertEqual(ValueCountResult.objects.filter(id=first).admit({first: 200}, budget=150), [first])
+        self.assertEqual(ValueCountResult.objects.get(id=first).cost, 200)
+
+        # Results that exceed the budget next to running results have to wait.
+        self.assertIsNone(ValueCountResult.objects.filter(id=second).admit({second: 100}, budget=150))
+        self.assertEqual(ValueCountResult.objects.get(id=second).status, ValueCountResult.SCHEDULED)
+
+        # Direct calls are always admitted.
+        with self.settings(RASTER_AGGREGATION_MAX_RUNNING_PIXELS=1):
+            compute_single_value_count_result(second)
+        result = ValueCountResult.objects.get(id=second)
+        self.assertEqual(result.status, ValueCountResult.FINISHED)
+        self.assertGreater(result.cost, 0)
+
+    def test_lease_heartbeat(self):
+        vc = ValueCountResult.objects.first()
+        expired = timezone.now() - datetime.timedelta(seconds=1)
+        ValueCountResult.objects.filter(id=vc.id).update(status=ValueCountResult.COMPUTING, lease_expires=expired)
+
+        with self.settings(RASTER_AGGREGATION_VALUE_COUNT_LEASE=1):
+            heartbeat = lease_heartbeat([vc.id])
+            # Leases are not renewed on every call.
+            heartbeat()
+            self.assertEqual(ValueCountResult.objects.get(id=vc.id).lease_expires, expired)
+            time.sleep(0.2)
+            heartbeat()
+        self.assertGreater(ValueCountResult.objects.get(id=vc.id).lease_expires, timezone.now())
+
+    def test_leases_are_not_shortened(self):
+        vc = ValueCountResult.objects.first()
+        ValueCountResult.objects.filter(id=vc.id).update(status=ValueCountResult.COMPUTING, lease_expires=None)
+
+        vc.renew_lease(factor=3)
+        lease_expires = ValueCountResult.objects.get(id=vc.id).lease_expires
+        self.assertGreater(lease_expires, ValueCountResult.lease_expiry(factor=2))
+
+        vc.renew_lease()
+        self.assertEqual(ValueCountResult.objects.get(id=vc.id).lease_expires, lease_expires)
+
+    def test_failed_parts_release_the_lease(self):
+        vc = ValueCountResult.objects.first()
+        ValueCountResult.objects.filter(id=vc.id).update(status=ValueCountResult.SCHEDULED)
+        ValueCountResult.objects.filter(id=vc.id).claim()
+        vc.refresh_from_db()
+
+        fail_value_count_parts(vc.id, str(vc.lease_token))
+        vc.refresh_from_db()
+        self.assertEqual(vc.status, ValueCountResult.FAILED)
+        self.assertIsNone(vc.lease_expires)
+
+    def test_results_are_only_stored_by_their_claim(self):
+        vc = ValueCountResult.objects.first()
+        ValueCountResult.objects.filter(id=vc.id).update(status=ValueCountResult.SCHEDULED)
+        ValueCountResult.objects.filter(id=vc.id).claim()
+        vc.refresh_from_db()
+        aggregate = vc.aggregate()
+
+        # Results that were outdated while they are computed are not claimed
+        # by other workers.
+        ValueCountResult.objects.filter(id=vc.id).update(status=ValueCountResult.OUTDATED)
+        self.assertEqual(ValueCountResult.objects.filter(id=vc.id).claim(), [])
+
+        # Results claimed by another worker are not overwritten.
+        ValueCountResult.objects.filter(id=vc.id).update(status=ValueCountResult.COMPUTING, lease_token=uuid.uuid4())
+        vc.store(aggregate)
+        result = ValueCountResult.objects.get(id=vc.id)
+        self.assertEqual(result.status, ValueCountResult.COMPUTING)
+        self.assertIsNotNone(result.lease_expires)
+
+        # The claiming worker stores its result without touching other columns.
+        accessed = timezone.now()
+        ValueCountResult.objects.filter(id=vc.id).update(accessed=accessed)
+        result.store(aggregate)
+        result = ValueCountResult.objects.get(id=vc.id)
+        self.assertEqual(result.status, ValueCountResult.FINISHED)
+        self.assertIsNone(result.lease_expires)
+        self.assertEqual(result.accessed, accessed)
+
+    def test_task_options(self):
+        self.assertEqual(task_options(), {})
+        with self.settings(RASTER_AGGREGATION_INTERACTIVE_QUEUE='interactive', RASTER_AGGREGATION_INTERACTIVE_PRIORITY=9):
+            self.assertEqual(task_options(interactive=True), {'queue': 'interactive', 'priority': 9})
+            self.assertEqual(task_options(), {})
+
+    def test_bulk_slots(self):
+        with self.settings(RASTER_AGGREGATION_BULK_CONCURRENCY=1):
+            slot = acquire_bulk_slot()
+            self.assertIsNone(acquire_bulk_slot())
+            release_bulk_slot(slot)
+            slot = acquire_bulk_slot()
+            self.assertIsNotNone(slot)
+            release_bulk_slot(slot)
+
+    def test_subdivided_value_counts(self):
+        vc = ValueCountResult.objects.get(aggregationarea__name='Coverall')
+        expected = {k: float(v) for k, v in vc.value.items()}
+        stats = (vc.stats_min, vc.stats_max, vc.stats_avg, vc.stats_std, vc.stats_cumsum_t0)
+
+        with self.settings(RASTER_AGGREGATION_SUBDIVIDE_PIXELS=1):
+            self.assertGreater(len(vc.subdivide()), 1)
+            ValueCountResult.objects.filter(id=vc.id).update(status=ValueCountResult.SCHEDULED, value={})
+            compute_single_value_count_result(vc.id)
+
+        vc.refresh_from_db()
+        self.assertEqual(vc.status, ValueCountResult.FINISHED)
+        self.assertIsNone(vc.lease_expires)
+        result = {k: float(v) for k, v in vc.value.items()}
+        self.assertEqual(result.keys(), expected.keys())
+        for key in expected:
+            self.assertAlmostEqual(result[key], expected[key])
+        for value, expected_value in zip((vc.stats_min, vc.stats_max, vc.stats_avg, vc.stats_std, vc.stats_cumsum_t0), stats):
+            self.assertAlmostEqual(value, expected_value)
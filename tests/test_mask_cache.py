@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from raster_aggregation.masks import mask_cache
+from raster_aggregation.models import AggregationArea, ValueCountResult
+from raster_aggregation.tasks import compute_value_count_for_aggregation_layer
+
+from .aggregation_testcase import RasterAggregationTestCase
+
+
+class MaskCacheTests(RasterAggregationTestCase):
+
+    def setUp(self):
+        super(MaskCacheTests, self).setUp()
+        self.mask_dir = tempfile.mkdtemp()
+        self.builds = 0
+
+    def tearDown(self):
+        super(MaskCacheTests, self).tearDown()
+        shutil.rmtree(self.mask_dir, ignore_errors=True)
+
+    def build(self):
+        self.builds += 1
+        return numpy.eye(4, dtype=bool)
+
+    def test_masks_are_built_once(self):
+        with self.settings(RASTER_AGGREGATION_MASK_CACHE_DIR=self.mask_dir):
+            mask = mask_cache.get((1, 'abc'), 3, 1, 2, True, self.build)
+            cached = mask_cache.get((1, 'abc'), 3, 1, 2, True, self.build)
+            self.assertEqual(self.builds, 1)
+            self.assertIsInstance(cached, numpy.memmap)
+            self.assertTrue(numpy.array_equal(mask, cached))
+
+            # Masks of changed areas are built again.
+            mask_cache.get((1, 'def'), 3, 1, 2, True, self.build)
+            self.assertEqual(self.builds, 2)
+
+            mask_cache.invalidate([1])
+            self.assertFalse(os.path.exists(os.path.join(self.mask_dir, '1')))
+
+    def test_masks_are_not_cached_without_directory(self):
+        mask_cache.get((1, 'abc'), 3, 1, 2, True, self.build)
+        mask_cache.get((1, 'abc'), 3, 1, 2, True, self.build)
+        self.assertEqual(self.builds, 2)
+
+    def test_least_recently_used_masks_are_evicted(self):
+        with self.settings(RASTER_AGGREGATION_MASK_CACHE_DIR=self.mask_dir):
+            first = mask_cache.path(1, 'abc', 3, 1, 2, True)
+            second = mask_cache.path(1, 'abc', 3, 1, 3, True)
+            mask_cache.get((1, 'abc'), 3, 1, 2, True, self.build)
+            mask_cache.get((1, 'abc'), 3, 1, 3, True, self.build)
+            os.utime(first, (0, 0))
+
+            with self.settings(RASTER_AGGREGATION_MASK_CACHE_SIZE=os.path.getsize(second)):
+                mask_cache.evict()
+
+            self.assertFalse(os.path.exists(first))
+            self.assertTrue(os.path.exists(second))
+
+    def test_masks_are_evicted_when_cache_is_full(self):
+        with self.settings(RASTER_AGGREGATION_MASK_CACHE_DIR=self.mask_dir):
+            first = mask_cache.path(1, 'abc', 3, 1, 2, True)
+            mask_cache.get((1, 'abc'), 3, 1, 2, True, self.build)
+            os.utime(first, (0, 0))
+
+            with self.settings(RASTER_AGGREGATION_MASK_CACHE_SIZE=os.path.getsize(first) * 3 // 2):
+                mask_cache.get((2, 'abc'), 3, 1, 2, True, self.build)
+
+            # The emptied area directory is removed.
+            self.assertFalse(os.path.exists(os.path.join(self.mask_dir, '1')))
+            self.assertTrue(os.path.exists(mask_cache.path(2, 'abc', 3, 1, 2, True)))
+
+    def test_value_counts_with_mask_cache(self):
+        with self.settings(RASTER_AGGREGATION_MASK_CACHE_DIR=self.mask_dir):
+            compute_value_count_for_aggregation_layer(self.agglayer, self.rasterlayer.id, compute_area=False)
+
+            area = AggregationArea.objects.get(name='St Petersburg')
+            self.assertTrue(os.listdir(os.path.join(self.mask_dir, str(area.id))))
+
+            # Results computed from cached masks are equal.
+            vc = ValueCountResult.objects.get(aggregationarea=area)
+            expected = vc.value
+            vc.populate()
+            vc.refresh_from_db()
+            self.assertEqual(vc.value, expected)
+
+            # Saving an area drops its masks.
+            area.save()
+            self.assertFalse(os.path.exists(os.path.join(self.mask_dir, str(area.id))))
@@ -1,6 +1,8 @@
 from __future__ import unicode_literals
 
-from raster_aggregation.models import AggregationLayer
+from django.contrib.gis.gdal import DataSource
+from raster_aggregation.models import AggregationArea, AggregationLayer
+from raster_aggregation.tasks import aggregation_layer_parser, shard_features
 
 from .aggregation_testcase import RasterAggregationTestCase
 
@@ -34,3 +36,77 @@ class AggregationAreaParseTests(RasterAggregationTestCase):
             'Finished parsing Aggregation Layer' in self.agglayer.parse_log
         )
         self.assertEqual(self.agglayer.status, AggregationLayer.FINISHED)
+
+    def test_parse_in_batches(self):
+        with self.settings(MEDIA_ROOT=self.media_root, RASTER_AGGREGATION_PARSE_BATCH_SIZE=1):
+            aggregation_layer_parser(self.agglayer.id)
+
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        self.assertFalse(self.agglayer.aggregationarea_set.filter(geom_simplified__isnull=True).exists())
+
+        self.agglayer.refresh_from_db()
+        self.assertEqual(self.agglayer.parse_log.count('Created batch of 1 out of 1 aggregation areas.'), 2)
+
+    def test_parse_in_shards(self):
+        with self.settings(MEDIA_ROOT=self.media_root, RASTER_AGGREGATION_PARSE_SHARD_SIZE=1):
+            aggregation_layer_parser(self.agglayer.id)
+
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+
+        self.agglayer.refresh_from_db()
+        self.assertIn('Parsing 2 features in 2 shards.', self.agglayer.parse_log)
+        self.assertEqual(self.agglayer.nr_of_areas, 2)
+        self.assertEqual(self.agglayer.status, AggregationLayer.FINISHED)
+
+    def test_shards_skip_missing_fids(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            lyr = DataSource('/vsizip/' + self.agglayer.shapefile.path)[0]
+            self.assertEqual([feat.fid for feat in shard_features(lyr, 1, 5)], [1])
+            self.assertEqual([feat.fid for feat in shard_features(lyr, 1, None)], [1])
+
+    def test_buffered_parse_log(self):
+        with self.settings(RASTER_AGGREGATION_PARSE_LOG_BUFFER_SIZE=3):
+            self.agglayer.log('Buffered message 1', buffered=True)
+            self.agglayer.log('Buffered message 2', buffered=True)
+            self.assertNotIn('Buffered message', AggregationLayer.objects.get(id=self.agglayer.id).parse_log)
+            self.agglayer.log('Buffered message 3', buffered=True)
+
+        parse_log = AggregationLayer.objects.get(id=self.agglayer.id).parse_log
+        for i in range(1, 4):
+            self.assertIn('Buffered message {0}'.format(i), parse_log)
+
+    def test_parse_log_max_length(self):
+        with self.settings(RASTER_AGGREGATION_PARSE_LOG_MAX_LENGTH=50):
+            self.agglayer.log('Last message')
+        self.agglayer.refresh_from_db()
+        self.assertEqual(len(self.agglayer.parse_log), 50)
+        self.assertTrue(self.agglayer.parse_log.endswith('Last message'))
+        self.assertEqual(self.agglayer.status, AggregationLayer.FINISHED)
+
+    def test_staged_areas_are_hidden_until_activated(self):
+        area = self.agglayer.aggregationarea_set.first()
+        AggregationArea.all_objects.filter(id=area.id).update(active=False)
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 1)
+
+        # Reparsing removes leftover staged areas and replaces the active ones.
+        old_ids = set(AggregationArea.all_objects.values_list('id', flat=True))
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id)
+
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        self.assertEqual(AggregationArea.all_objects.filter(aggregationlayer=self.agglayer).count(), 2)
+        self.assertFalse(AggregationArea.all_objects.filter(id__in=old_ids).exists())
+
+    def test_parse_with_deferred_simplification(self):
+        with self.settings(MEDIA_ROOT=self.media_root, RASTER_AGGREGATION_DEFER_SIMPLIFICATION=True):
+            aggregation_layer_parser(self.agglayer.id)
+
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        self.assertFalse(self.agglayer.aggregationarea_set.filter(geom_simplified__isnull=True).exists())
+
+    def test_simplify_areas_in_database(self):
+        self.agglayer.aggregationarea_set.update(geom_simplified=None)
+        self.agglayer.simplify_areas()
+        for area in self.agglayer.aggregationarea_set.all():
+            self.assertTrue(area.geom_simplified.valid)
+            self.assertEqual(area.geom_simplified.geom_type, 'MultiPolygon')
@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+
+from raster.models import RasterLayer
+from raster.tiles.parser import rasterlayers_parser_ended
+
+from raster_aggregation.cache import raster_size, tile_cache
+from raster_aggregation.models import ValueCountResult
+from raster_aggregation.tasks import compute_value_count_for_aggregation_layer
+
+from .aggregation_testcase import RasterAggregationTestCase
+
+
+class TileCacheTests(RasterAggregationTestCase):
+
+    def setUp(self):
+        super(TileCacheTests, self).setUp()
+        tile_cache.clear()
+
+    def test_tiles_are_read_once_for_all_areas(self):
+        compute_value_count_for_aggregation_layer(self.agglayer, self.rasterlayer.id, compute_area=False)
+        stats = tile_cache.stats()
+        self.assertGreater(stats['hits'], 0)
+        self.assertEqual(stats['tiles'], stats['misses'])
+
+        # Repopulating a result only reads from the cache.
+        ValueCountResult.objects.first().populate()
+        self.assertEqual(tile_cache.stats()['misses'], stats['misses'])
+
+    def test_cache_size_is_bounded(self):
+        tile = self.rasterlayer.rastertile_set.filter(tilez=11).first()
+        with self.settings(RASTER_AGGREGATION_TILE_CACHE_SIZE=raster_size(tile.rast)):
+            tile_cache.get(self.rasterlayer.id, 11, tile.tilex, tile.tiley)
+            tile_cache.get(self.rasterlayer.id, 11, tile.tilex + 1, tile.tiley)
+        self.assertEqual(tile_cache.stats()['tiles'], 1)
+        self.assertLessEqual(tile_cache.stats()['bytes'], raster_size(tile.rast))
+
+    def test_missing_tiles_are_not_cached(self):
+        self.assertIsNone(tile_cache.get(self.rasterlayer.id, 11, 0, 0))
+        self.assertEqual(tile_cache.stats()['tiles'], 0)
+
+    def test_parser_signal_invalidates_cache(self):
+        tile = self.rasterlayer.rastertile_set.filter(tilez=11).first()
+        version = tile_cache.versions([self.rasterlayer.id])[self.rasterlayer.id]
+        tile_cache.get(self.rasterlayer.id, 11, tile.tilex, tile.tiley, version)
+
+        rasterlayers_parser_ended.send(sender=RasterLayer, instance=self.rasterlayer)
+
+        self.assertEqual(tile_cache.stats()['tiles'], 0)
+        self.assertGreater(tile_cache.versions([self.rasterlayer.id])[self.rasterlayer.id], version)
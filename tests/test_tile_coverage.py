@@ -0,0 +1,92 @@
+from __future__ import unicode_literals
+
+from raster.tiles.utils import tile_bounds, tile_index_range
+from raster.valuecount import Aggregator
+
+from django.contrib.gis.geos import Polygon
+from raster_aggregation.cache import CachedAggregator
+from raster_aggregation.models import AggregationArea, AggregationAreaTile, coverage_tileranges
+
+from .aggregation_testcase import RasterAggregationTestCase
+
+
+class TileCoverageTests(RasterAggregationTestCase):
+
+    def setUp(self):
+        super(TileCoverageTests, self).setUp()
+        self.zoom = self.rasterlayer.metadata.max_zoom
+
+    def test_coverage_matches_tile_geometries(self):
+        area = AggregationArea.objects.get(name='St Petersburg')
+        tilerange = tile_index_range(area.geom.extent, self.zoom)
+        coverage = area.tile_coverage(self.zoom, tilerange)
+
+        expected = {}
+        xmin, ymin, xmax, ymax = tilerange
+        for tilex in range(xmin, xmax + 1):
+            for tiley in range(ymin, ymax + 1):
+                bbox = Polygon.from_bbox(tile_bounds(tilex, tiley, self.zoom))
+                bbox.srid = area.geom.srid
+                if area.geom.intersects(bbox):
+                    expected[(tilex, tiley)] = area.geom.contains(bbox)
+        self.assertEqual(coverage, expected)
+
+        # The coverage is stored once.
+        tiles = AggregationAreaTile.objects.filter(aggregationarea=area, zoom=self.zoom)
+        count = tiles.count()
+        self.assertEqual(area.tile_coverage(self.zoom, tilerange), expected)
+        self.assertEqual(tiles.count(), count)
+
+    def test_interior_tiles_are_stored_at_lower_levels(self):
+        area = AggregationArea.objects.get(name='Coverall')
+        tilerange = tile_index_range(area.geom.extent, self.zoom)
+        coverage = area.tile_coverage(self.zoom, tilerange)
+
+        tiles = AggregationAreaTile.objects.filter(aggregationarea=area, zoom=self.zoom)
+        self.assertTrue(tiles.filter(tilez__lt=self.zoom, interior=True).exists())
+        self.assertFalse(tiles.filter(tilez__lt=self.zoom, interior=False).exists())
+        self.assertLess(tiles.count(), len(coverage))
+
+    def test_coverage_in_tilerange(self):
+        area = AggregationArea.objects.get(name='St Petersburg')
+        xmin, ymin, xmax, ymax = tile_index_range(area.geom.extent, self.zoom)
+        coverage = area.tile_coverage(self.zoom, [xmin, ymin, xmax, ymax])
+
+        expected = {index: interior for index, interior in coverage.items() if index[0] == xmin}
+        self.assertEqual(area.tile_coverage(self.zoom, [xmin, ymin, xmin, ymax]), expected)
+
+    def test_coverage_is_clipped_to_raster_layers(self):
+        area = AggregationArea.objects.get(name='Coverall')
+        tilerange = coverage_tileranges([area], [self.rasterlayer.id], self.zoom)[0]
+        layer_range = tile_index_range(self.rasterlayer.extent(), self.zoom)
+        self.assertGreaterEqual(tilerange[0], layer_range[0])
+        self.assertGreaterEqual(tilerange[1], layer_range[1])
+        self.assertLessEqual(tilerange[2], layer_range[2])
+        self.assertLessEqual(tilerange[3], layer_range[3])
+
+        coverage = area.tile_coverage(self.zoom, tilerange)
+        for tilex, tiley in coverage:
+            self.assertTrue(tilerange[0] <= tilex <= tilerange[2] and tilerange[1] <= tiley <= tilerange[3])
+
+    def test_coverage_is_rebuilt_after_save(self):
+        area = AggregationArea.objects.get(name='St Petersburg')
+        area.tile_coverage(self.zoom, tile_index_range(area.geom.extent, self.zoom))
+        area.save()
+        self.assertFalse(AggregationAreaTile.objects.filter(aggregationarea=area).exists())
+
+    def test_value_counts_with_coverage(self):
+        area = AggregationArea.objects.get(name='Coverall')
+        coverage = area.tile_coverage(self.zoom, tile_index_range(area.geom.extent, self.zoom))
+        self.assertIn(True, coverage.values())
+
+        params = {
+            'layer_dict': {'a': self.rasterlayer.id},
+            'formula': 'a',
+            'zoom': self.zoom,
+            'geom': area.geom,
+            'grouping': 'discrete',
+        }
+        expected = Aggregator(**params)
+        agg = CachedAggregator(coverage=coverage, **params)
+        self.assertEqual(agg.value_count(), expected.value_count())
+        self.assertEqual(agg.statistics(), expected.statistics())
@@ -0,0 +1,33 @@
+from __future__ import unicode_literals
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.test import TestCase
+from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygon, convert_to_multipolygons
+
+
+class ConvertToMultipolygonsTests(TestCase):
+
+    def setUp(self):
+        self.geoms = [
+            # Valid polygon.
+            GEOSGeometry('POLYGON((0 0, 0 1, 1 1, 1 0, 0 0))', srid=WEB_MERCATOR_SRID),
+            # Self intersecting bowtie polygon.
+            GEOSGeometry('POLYGON((0 0, 1 1, 1 0, 0 1, 0 0))', srid=WEB_MERCATOR_SRID),
+            # Line without area.
+            GEOSGeometry('LINESTRING(0 0, 1 1)', srid=WEB_MERCATOR_SRID),
+        ]
+
+    def test_convert_to_multipolygons(self):
+        result = convert_to_multipolygons(self.geoms)
+        self.assertEqual(len(result), 3)
+        for geom in result:
+            self.assertEqual(geom.geom_type, 'MultiPolygon')
+            self.assertTrue(geom.valid)
+            self.assertEqual(geom.srid, WEB_MERCATOR_SRID)
+        self.assertAlmostEqual(result[0].area, 1)
+        self.assertAlmostEqual(result[1].area, 0.5)
+        self.assertTrue(result[2].empty)
+
+    def test_convert_to_multipolygons_matches_single_conversion(self):
+        for geom, converted in zip(self.geoms, convert_to_multipolygons(self.geoms)):
+            self.assertTrue(converted.equals(convert_to_multipolygon(geom)) or converted.empty)
@@ -6,6 +6,7 @@ from raster.tiles.utils import tile_bounds
 
 from django.contrib.gis.gdal import OGRGeometry
 from django.urls import reverse
+from raster_aggregation.models import AggregationAreaGeometry
 
 from .aggregation_testcase import RasterAggregationTestCase
 
@@ -66,3 +67,22 @@ class VectorTilesTests(RasterAggregationTestCase):
         # Setup request with fromula that will multiply the rasterlayer by itself
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 404)
+
+    def test_geometry_pyramid_was_built(self):
+        self.assertEqual(AggregationAreaGeometry.objects.filter(aggregationarea__aggregationlayer=self.agglayer).count(), 8)
+        self.assertEqual(
+            sorted(set(AggregationAreaGeometry.objects.values_list('zoom', flat=True))),
+            [0, 3, 6, 9],
+        )
+
+    def test_vector_tile_endpoint_json_low_zoom(self):
+        # Get url for the parent tile of the tile above, which is served from
+        # the geometry pyramid.
+        self.url = reverse('vectortiles-list', kwargs={'aggregationlayer': self.agglayer.id, 'z': 9, 'x': 138, 'y': 214, 'frmt': 'json'})
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode())
+        self.assertEqual(
+            ['St Petersburg', 'Coverall'],
+            [feat['properties']['name'] for feat in result['features']],
+        )